@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import zipfile
+import hashlib
+import tempfile
+import pandas as pd
+from fields import COLUMNS, FIELDS
+from instrument import step
+
+TEMPLATE_DIR = 'card-templates'
+NOTE_TYPE = 'Species'
+HEADER_LINES = 6 # Anki directives at the top of the deck csv
+NOTE_ID_BASE = 1_500_000_000_000 # Ids are creation times in milliseconds, this keeps them in a plausible range
+BASE91 = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&()*+,-./:;<=>?@[]^_`{|}~'
+
+# Collection schema 11, which every Anki version can import
+SCHEMA = '''
+CREATE TABLE col (id integer primary key, crt integer not null, mod integer not null, scm integer not null, ver integer not null, dty integer not null, usn integer not null, ls integer not null, conf text not null, models text not null, decks text not null, dconf text not null, tags text not null);
+CREATE TABLE notes (id integer primary key, guid text not null, mid integer not null, mod integer not null, usn integer not null, tags text not null, flds text not null, sfld integer not null, csum integer not null, flags integer not null, data text not null);
+CREATE TABLE cards (id integer primary key, nid integer not null, did integer not null, ord integer not null, mod integer not null, usn integer not null, type integer not null, queue integer not null, due integer not null, ivl integer not null, factor integer not null, reps integer not null, lapses integer not null, left integer not null, odue integer not null, odid integer not null, flags integer not null, data text not null);
+CREATE TABLE revlog (id integer primary key, cid integer not null, usn integer not null, ease integer not null, ivl integer not null, lastIvl integer not null, factor integer not null, time integer not null, type integer not null);
+CREATE TABLE graves (usn integer not null, oid integer not null, type integer not null);
+CREATE INDEX ix_notes_usn on notes (usn);
+CREATE INDEX ix_cards_usn on cards (usn);
+CREATE INDEX ix_revlog_usn on revlog (usn);
+CREATE INDEX ix_cards_nid on cards (nid);
+CREATE INDEX ix_cards_sched on cards (did, queue, due);
+CREATE INDEX ix_revlog_cid on revlog (cid);
+CREATE INDEX ix_notes_csum on notes (csum);
+'''
+
+DECK_OPTIONS = {
+    'id': 1, 'name': 'Default', 'mod': 0, 'usn': 0, 'maxTaken': 60, 'autoplay': True, 'timer': 0, 'replayq': True, 'dyn': False,
+    'new': {'bury': True, 'delays': [1, 10], 'initialFactor': 2500, 'ints': [1, 4, 7], 'order': 1, 'perDay': 20, 'separate': True},
+    'lapse': {'delays': [10], 'leechAction': 0, 'leechFails': 8, 'minInt': 1, 'mult': 0},
+    'rev': {'bury': True, 'ease4': 1.3, 'fuzz': 0.05, 'ivlFct': 1, 'maxIvl': 36500, 'minSpace': 1, 'perDay': 100},
+}
+
+
+def stable_id(*parts):
+    return int.from_bytes(hashlib.sha256('|'.join(map(str, parts)).encode()).digest()[:6], 'big')
+
+# Note GUID derived from the deck and EOL ID, so a new release updates the notes of the previous one.
+# Encoded in base 91 like the GUIDs Anki creates itself.
+def note_guid(species_type, eol_id):
+    number = int.from_bytes(hashlib.sha256(f'anki-animals|{species_type}|{eol_id}'.encode()).digest()[:8], 'big')
+    guid = ''
+    while number:
+        number, digit = divmod(number, len(BASE91))
+        guid = BASE91[digit] + guid
+    return guid or BASE91[0]
+
+# First 8 hex digits of the SHA-1 of the first field (without HTML), used by Anki to find duplicates
+def field_checksum(text):
+    return int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16)
+
+def strip_html(text):
+    return re.sub(r'<[^>]*>', '', text).strip()
+
+
+def read_template(name):
+    with open(os.path.join(TEMPLATE_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+def note_type(model_id, deck_id, now):
+    return {
+        'id': model_id, 'name': NOTE_TYPE, 'type': 0, 'mod': now, 'usn': -1, 'sortf': 0, 'did': deck_id,
+        'tmpls': [{'name': 'Card 1', 'ord': 0, 'qfmt': read_template('front.html'), 'afmt': read_template('back.html'), 'bqfmt': '', 'bafmt': '', 'did': None, 'bfont': '', 'bsize': 0}],
+        'flds': [{'name': name, 'ord': i, 'sticky': False, 'rtl': False, 'font': 'Arial', 'size': 20, 'media': []} for i, name in enumerate(FIELDS)],
+        'css': read_template('style.css'),
+        'latexPre': '\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage[utf8]{inputenc}\n\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n\\begin{document}\n',
+        'latexPost': '\\end{document}', 'latexsvg': False,
+        'req': [[0, 'any', [0]]], 'tags': [], 'vers': [],
+    }
+
+def deck_entry(deck_id, name, now):
+    return {'id': deck_id, 'name': name, 'desc': '', 'mod': now, 'usn': -1, 'collapsed': False, 'browserCollapsed': False, 'dyn': 0, 'conf': 1,
+            'extendNew': 0, 'extendRev': 0, 'newToday': [0, 0], 'revToday': [0, 0], 'lrnToday': [0, 0], 'timeToday': [0, 0]}
+
+
+def read_deck_csv(species_type, path=None):
+    path = path or os.path.join('data', 'output', f'The {species_type} Deck.csv')
+    return pd.read_csv(path, skiprows=HEADER_LINES, header=None, names=COLUMNS, dtype=str, keep_default_na=False)
+
+# Writes the collection database with all notes and cards in one transaction
+def write_collection(path, df, species_type):
+    now = int(time.time())
+    deck_name = f'The {species_type} Deck'
+    # The note type keeps its id between releases, so Anki recognizes it on import
+    model_id = stable_id('anki-animals', 'note type', NOTE_TYPE)
+    deck_id = stable_id('anki-animals', 'deck', deck_name)
+
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.executescript(SCHEMA)
+    with connection:
+        conf = {'activeDecks': [1], 'curDeck': 1, 'newSpread': 0, 'collapseTime': 1200, 'timeLim': 0, 'estTimes': True, 'dueCounts': True,
+                'curModel': None, 'nextPos': len(df) + 1, 'sortType': 'noteFld', 'sortBackwards': False, 'addToCur': True}
+        decks = {'1': deck_entry(1, 'Default', now), str(deck_id): deck_entry(deck_id, deck_name, now)}
+        connection.execute('INSERT INTO col VALUES (1, ?, ?, ?, 11, 0, 0, 0, ?, ?, ?, ?, ?)', (
+            now, now * 1000, now * 1000, json.dumps(conf), json.dumps({str(model_id): note_type(model_id, deck_id, now)}),
+            json.dumps(decks), json.dumps({'1': DECK_OPTIONS}), '{}'))
+
+        eol_ids = df['EOL ID'].tolist()
+        # Note ids only need to be unique in the package, Anki matches notes on the GUID
+        note_ids = [NOTE_ID_BASE + int(eol_id) for eol_id in eol_ids]
+        fields = df[FIELDS[0]].str.cat(df[FIELDS[1:]], sep='\x1f').tolist()
+        tags = (' ' + df['Tags'].str.strip() + ' ').tolist()
+        sort_fields = df[FIELDS[0]].map(strip_html).tolist()
+        connection.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, -1, ?, ?, ?, ?, 0, '')", (
+            (note_id, note_guid(species_type, eol_id), model_id, now, tag, flds, sort_field, field_checksum(sort_field))
+            for note_id, eol_id, tag, flds, sort_field in zip(note_ids, eol_ids, tags, fields, sort_fields)))
+        # New cards are shown in the order of the csv
+        connection.executemany("INSERT INTO cards VALUES (?, ?, ?, 0, ?, -1, 0, 0, ?, 0, 0, 0, 0, 0, 0, 0, 0, '')", (
+            (note_id, note_id, deck_id, now, position) for position, note_id in enumerate(note_ids, 1)))
+    connection.close()
+
+# Packs the notes of df into an Anki package at path
+def write_apkg(df, species_type, path):
+    with tempfile.TemporaryDirectory() as directory:
+        collection = os.path.join(directory, 'collection.anki2')
+        write_collection(collection, df, species_type)
+        with zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as package:
+            package.write(collection, 'collection.anki2')
+            package.writestr('media', '{}')
+        os.replace(path + '.tmp', path)
+
+# Writes 'The <type> Deck.apkg' from the deck csv, to import directly into Anki
+def create_apkg(deck):
+    species_type = deck.value['type']
+    print("Creating Anki package...")
+    df = read_deck_csv(species_type).drop_duplicates(subset=['EOL ID'])
+    with step('write apkg', rows_in=len(df)) as s:
+        write_apkg(df, species_type, os.path.join('data', 'output', f'The {species_type} Deck.apkg'))
+        s.rows_out = len(df)
@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import importlib
+import contextlib
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+
+# resource is only available on Unix, elsewhere peak RSS is not recorded
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import pandas as pd
+from taxa import Deck
+from pipeline import STAGES
+from synthetic import GENERATOR_VERSION, generate_inputs, generate_inaturalist_cache
+
+BENCHMARK_DIR = os.path.join('data', 'benchmarks')
+RESULTS_PATH = os.path.join(BENCHMARK_DIR, 'results.jsonl')
+SCALES = {'10k': 10_000, '100k': 100_000, '1M': 1_000_000}
+# Caches kept between stages: the iNaturalist cache is the fixture that replaces the API
+CACHED_FIXTURES = {'inaturalist.sqlite'}
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+PHOTO_MISSING_RATE = 0.01 # Share of deleted photos in the mock for the validate stage
+STARTUP_RUNS = 5 # Startup takes milliseconds, so it is always measured several times
+# Only the stages may import these, the command line has to start without them
+HEAVY_MODULES = {'pandas', 'numpy', 'pyarrow', 'bs4', 'requests', 'tqdm', 'unidecode'}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # Includes finished worker processes, e.g. the description cleaning pool
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+# Runs one stage in the benchmark directory (called in a fresh process, so peak RSS is for this stage only)
+def measure(directory, module, function, argument, verbose, options):
+    os.chdir(directory)
+    stage_function = getattr(importlib.import_module(module), function)
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with output:
+        start = time.perf_counter()
+        stage_function(argument, **options)
+        seconds = time.perf_counter() - start
+    return seconds, peak_rss_mb()
+
+
+# Starts the command line (main.py --help) in new processes.
+# Returns the fastest wall time and the heavy modules it imported.
+def measure_startup(repeat):
+    runs = []
+    for _ in range(max(repeat, STARTUP_RUNS)):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, MAIN_PATH, '--help'], capture_output=True, check=True)
+        runs.append(time.perf_counter() - start)
+    imports = subprocess.run([sys.executable, '-X', 'importtime', MAIN_PATH, '--help'], capture_output=True, text=True, check=True).stderr
+    imported = {line.rsplit('|', 1)[-1].strip().split('.')[0] for line in imports.splitlines() if line.startswith('import time:')}
+    return min(runs), sorted(imported & HEAVY_MODULES)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+# Generates the synthetic inputs for a scale once and reuses them while the generator is unchanged
+def prepare_inputs(directory, taxa, seed):
+    input_dir = os.path.join(directory, 'data', 'input')
+    marker = os.path.join(input_dir, 'synthetic.json')
+    if os.path.exists(marker):
+        with open(marker, encoding='utf-8') as f:
+            if json.load(f) == {'taxa': taxa, 'seed': seed, 'version': GENERATOR_VERSION}:
+                return
+    shutil.rmtree(directory, ignore_errors=True)
+    print(f"Generating synthetic inputs for {taxa} taxa...")
+    start = time.perf_counter()
+    generate_inputs(input_dir, taxa, seed)
+    print(f"Generated in {time.perf_counter() - start:.1f}s")
+
+# Removes the caches built by earlier runs, so every stage is measured from the raw inputs
+def clear_caches(directory):
+    cache_dir = os.path.join(directory, 'data', 'cache')
+    if not os.path.exists(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name in CACHED_FIXTURES:
+            continue
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+def count_rows(path):
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f) - 1
+
+def species_ids(directory, deck):
+    path = os.path.join(directory, 'data', 'processed', f"{deck.value['type']} species.csv")
+    return pd.read_csv(path, usecols=['inaturalistID'])['inaturalistID'].unique()
+
+
+# With api (the settings of MockINaturalistServer and the client rate in calls per second), the images
+# stage fetches every taxon from a local mock of the iNaturalist API instead of reading the cached fixture
+def run_benchmarks(scale, deck, stages, seed=0, warm=False, repeat=1, verbose=False, api=None):
+    taxa = SCALES[scale] if scale in SCALES else int(scale)
+    directory = os.path.abspath(os.path.join(BENCHMARK_DIR, scale))
+    prepare_inputs(directory, taxa, seed)
+    for folder in ['processed', 'output']:
+        os.makedirs(os.path.join(directory, 'data', folder), exist_ok=True)
+    # The package stage reads the card templates
+    shutil.copytree('card-templates', os.path.join(directory, 'card-templates'), dirs_exist_ok=True)
+
+    commit = git_commit()
+    records = []
+    server = None
+    if 'startup' in stages:
+        seconds, heavy_imports = measure_startup(repeat)
+        record = {**new_record(commit, scale, deck, 'startup', warm, repeat, seconds, None, None), 'heavy_imports': heavy_imports}
+        print(f"{'startup':<15} {seconds:>9.3f}s{'  imports ' + ', '.join(heavy_imports) if heavy_imports else ''}")
+        records.append(record)
+    for stage in STAGES:
+        if stage.name not in stages:
+            continue
+        options = {}
+        if stage.name == 'images' and api:
+            # Everything is refetched (ttl=0) from the mock, which rate limits like the client
+            from mock_inaturalist import MockINaturalistServer
+            server = MockINaturalistServer(latency=api['latency'], jitter=api['latency'] / 2, calls=api['rate'], period=1, error_rate=api['error_rate'], seed=seed).__enter__()
+            options = {'ttl': 0, 'api_url': server.url, 'calls': api['rate'], 'period': 1}
+        elif stage.name == 'images':
+            # The iNaturalist fixture: every taxon is cached, so only result processing is measured
+            from inat_cache import TaxonCache
+            with TaxonCache(path=os.path.join(directory, 'data', 'cache', 'inaturalist.sqlite')) as cache:
+                missing = cache.stale_ids(species_ids(directory, deck))
+                generate_inaturalist_cache(cache, missing, seed)
+        elif stage.name == 'validate':
+            # Photos are always checked against the mock, every run unless --warm
+            from mock_inaturalist import MockINaturalistServer
+            latency = api['latency'] if api else 0
+            server = MockINaturalistServer(latency=latency, jitter=latency / 2, photo_missing_rate=PHOTO_MISSING_RATE, seed=seed).__enter__()
+            options = {'photo_url': server.url, **({} if warm else {'ttl': 0})}
+
+        # The fastest of the repeats is the least disturbed by other processes
+        runs = []
+        for _ in range(repeat):
+            if not warm:
+                clear_caches(directory)
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                runs.append(executor.submit(measure, directory, stage.module, stage.function, [deck] if stage.multi_deck else deck, verbose, options).result())
+        seconds, rss = min(runs)
+        # Rows are the input taxa for the taxa stage and the deck's species for the others
+        rows = taxa if stage.name == 'taxa' else count_rows(os.path.join(directory, stage.paths(deck)[0][0]))
+        record = {**new_record(commit, scale, deck, stage.name, warm, repeat, seconds, rss, rows), 'mock_api': api if options else None}
+        if server:
+            # Requests and responses by status over all repeats
+            record['api'] = server.stats()
+            server.__exit__()
+            server = None
+        print(f"{stage.name:<15} {record['seconds']:>9.2f}s {rss or 0:>9.1f} MiB {record['rows_per_second'] or 0:>10} rows/s")
+        records.append(record)
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    with open(RESULTS_PATH, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    return records
+
+
+def new_record(commit, scale, deck, stage, warm, repeat, seconds, rss, rows):
+    return {
+        'commit': commit,
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'scale': scale,
+        'deck': deck.name,
+        'stage': stage,
+        'warm': warm,
+        'repeat': repeat,
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': rss,
+        'rows': rows,
+        'rows_per_second': round(rows / seconds) if rows and seconds else None,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'generator': GENERATOR_VERSION,
+        'mock_api': None,
+    }
+
+def load_results():
+    if not os.path.exists(RESULTS_PATH):
+        return []
+    with open(RESULTS_PATH, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Compares each stage with the latest result of another commit at the same scale.
+# Returns the stages that got slower (or used more memory) by more than the threshold.
+def compare(records, threshold):
+    history = load_results()
+    regressions = []
+    for record in records:
+        if record.get('heavy_imports'):
+            print(f"{record['stage']:<15} imports {', '.join(record['heavy_imports'])} at startup  REGRESSION")
+            regressions.append(record['stage'])
+        previous = [old for old in history if old['commit'] != record['commit'] and all(old.get(key) == record[key] for key in ['scale', 'deck', 'stage', 'warm', 'generator', 'mock_api'])]
+        if not previous:
+            print(f"{record['stage']:<15} no earlier commit to compare with")
+            continue
+        old = previous[-1]
+        time_change = record['seconds'] / old['seconds'] - 1 if old['seconds'] else 0
+        rss_change = record['peak_rss_mb'] / old['peak_rss_mb'] - 1 if record['peak_rss_mb'] and old['peak_rss_mb'] else 0
+        flag = ''
+        if time_change > threshold or rss_change > threshold:
+            regressions.append(record['stage'])
+            flag = '  REGRESSION'
+        print(f"{record['stage']:<15} vs {old['commit']}: time {time_change:+.1%}, peak RSS {rss_change:+.1%}{flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    stage_names = ['startup'] + [stage.name for stage in STAGES]
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic inputs.')
+    parser.add_argument('--scale', default='10k', help=f"number of taxa: {', '.join(SCALES)} or a number (default 10k)")
+    parser.add_argument('--deck', default='ANIMALS', choices=[deck.name for deck in Deck])
+    parser.add_argument('--stages', nargs='+', default=stage_names, choices=stage_names)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warm', action='store_true', help='keep the Parquet and description caches of earlier runs')
+    parser.add_argument('--repeat', type=int, default=1, help='run each stage this many times and keep the fastest')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression (default 0.1)')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the stages')
+    parser.add_argument('--mock-api', action='store_true', help='fetch the images stage from a local mock of the iNaturalist API')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='seconds per mock API response (default 0.05)')
+    parser.add_argument('--api-rate', type=float, default=20, help='mock API requests per second (default 20)')
+    parser.add_argument('--api-error-rate', type=float, default=0.02, help='share of mock API requests failing with 429 or 5xx (default 0.02)')
+    args = parser.parse_args()
+
+    api = {'latency': args.api_latency, 'rate': args.api_rate, 'error_rate': args.api_error_rate} if args.mock_api else None
+    records = run_benchmarks(args.scale, Deck[args.deck], args.stages, args.seed, args.warm, args.repeat, args.verbose, api)
+    if compare(records, args.threshold):
+        sys.exit(1)
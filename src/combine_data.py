@@ -1,79 +1,139 @@
 import pandas as pd
+import numpy as np
 import os
-from functools import reduce
+import re
 from string import capwords
-from translations import LANGUAGES
+from fields import LANGUAGES, COLUMNS
+from instrument import step
+from image_field import compact_images
 
-UNWANTED_IMGS = {'<img src="https://www.inaturalist.org/assets/copyright-infringement-large.png">'}
+UNWANTED_IMG_URLS = {'https://www.inaturalist.org/assets/copyright-infringement-large.png'}
 UNWANTED_SPECIES = {879101}
-COLUMNS = ['Scientific', 'EOL ID', 'iNaturalist ID', 'GBIF ID', 'Conservation status', 'Observations', 'Taxonomic sort', 'Observations sort', 'Identification', 'Images', 'Tags']
-COLUMNS.extend([language for language, _ in LANGUAGES])
 
-# Create sortable string of numbers with leading zeros using current order
-def create_sort_string(df, name):
-    df[name] = df.reset_index(drop=True).index.map(lambda i: f"{i:06d}")
+# Columns read from each processed file with their types
+PROCESSED_FILES = {
+    'species.csv': {'canonicalName': str, 'eolID': 'int64', 'inaturalistID': 'int64', 'gbifID': 'int64'},
+    'species with identification.csv': {'eolID': 'int64', 'identification': str},
+    'species with translations.csv': {'eolID': 'int64', **{language: str for language, _ in LANGUAGES}},
+    'species with countries.csv': {'eolID': 'int64', 'countries': str},
+    'species with images.csv': {'eolID': 'int64', 'images': str, 'conservation_status': 'category', 'observations_count': 'Int64', 'preferred_common_name': str, 'taxonomy_tag': str, 'rank': 'category'},
+}
 
+# Create sortable strings of numbers with leading zeros from positions
+def create_sort_string(positions):
+    return pd.Series(positions).astype(str).str.zfill(6).to_numpy()
 
-def create_csv(df, species_type):
+
+# File header for Anki
+def csv_header(deck_name):
+    return f'#separator:Comma\n#html:true\n#notetype:Species\n#deck:{deck_name}\n#tags column:{COLUMNS.index("Tags") + 1}\n#columns:{",".join(COLUMNS)}\n'
+
+def create_csv(df, species_type, path=None):
     deck_name = f'The {species_type} Deck'
-    with open(os.path.join('data', 'output', f'{deck_name}.csv'), 'w', encoding='utf-8', newline='') as f:
-        # File header for Anki
-        f.write(f'#separator:Comma\n#html:true\n#notetype:Species\n#deck:{deck_name}\n#tags column:{COLUMNS.index("Tags") + 1}\n#columns:{",".join(COLUMNS)}\n')
-        
+    with open(path or os.path.join('data', 'output', f'{deck_name}.csv'), 'w', encoding='utf-8', newline='') as f:
+        f.write(csv_header(deck_name))
+
         df.to_csv(f, index=False, header=False)
 
 
-def remove_unwanted_imgs(df):
-    df['images'] = df['images'].apply(lambda x: ';;'.join(
-            [img for img in x.split(';;') if img.split('|')[0] not in UNWANTED_IMGS]
-        ) if isinstance(x, str) else x)
-    
-# Combines data from different sources into one dataframe
-def combine_data(deck):
-    print("Combining data...")
-    all_dfs = [pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} {file}'), low_memory=False) for file in ['species.csv', 'species with identification.csv', 'species with translations.csv', 'species with countries.csv', 'species with images.csv']]
+def remove_unwanted_img(images, unwanted=UNWANTED_IMG_URLS):
+    return ';;'.join([img for img in images.split(';;') if re.match(r'<img src="([^"]*)"', img).group(1) not in unwanted])
 
-    # Merge dataframes into one
-    df = reduce(lambda left, right: pd.merge(left, right, on='eolID', how='left'), all_dfs)
+# Only the few notes that contain an unwanted image are split and joined again.
+# bad_images lists the images of each taxon that the validate stage found broken, placeholders or duplicates.
+def remove_unwanted_imgs(df, bad_images):
+    contains_unwanted = df['images'].str.contains('|'.join(map(re.escape, UNWANTED_IMG_URLS)), na=False)
+    df.loc[contains_unwanted, 'images'] = df.loc[contains_unwanted, 'images'].map(remove_unwanted_img)
 
-    remove_unwanted_imgs(df)
+    bad_urls = bad_images.groupby('eolID')['url'].agg(set)
+    flagged = df['eolID'].isin(bad_urls.index)
+    df.loc[flagged, 'images'] = [remove_unwanted_img(images, urls) for images, urls in zip(df.loc[flagged, 'images'], df.loc[flagged, 'eolID'].map(bad_urls))]
 
-    # Remove unwanted ranks (keep species complexes)
-    df = df[df['rank'].isin(deck.value['taxon_rank'] + ['complex'])]
 
-    # Remove unwanted species
-    df = df[~df['eolID'].isin(UNWANTED_SPECIES)]
+def read_processed(deck, file):
+    dtype = PROCESSED_FILES[file]
+    df = pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} {file}'), usecols=list(dtype), dtype=dtype)
+    return df.set_index('eolID')
 
-    # Remove if in wrong kingdom
-    df = df[df['taxonomy_tag'].str.startswith(deck.value['kingdom'])]
+# Taxa of the images file that belong in the deck: wanted ranks (and species complexes) in the deck's kingdom
+def wanted_taxa(df_images, deck):
+    return df_images['rank'].isin(deck.value['taxon_rank'] + ['complex']) & df_images['taxonomy_tag'].str.startswith(deck.value['kingdom'])
 
-    # Prefer the English names from iNaturalist
-    df['English'] = df['preferred_common_name'].combine_first(df['English'])
-    df['English'] = df['English'].fillna('').apply(capwords)
+# Combines data from different sources into one dataframe
+def combine_data(deck):
+    print("Combining data...")
+    with step('filter images') as s:
+        df_images = read_processed(deck, 'species with images.csv')
+        s.rows_in = len(df_images)
+
+        # Remove unwanted ranks (keep species complexes) and taxa in the wrong kingdom before joining
+        df_images = df_images[wanted_taxa(df_images, deck)]
+
+        # Remove empty cards
+        print(f"Removing {df_images['images'].isnull().sum()} species with no images")
+        df_images = df_images.dropna(subset=['images'])
+        s.rows_out = len(df_images)
 
-    # Remove empty cards
-    print(f"Removing {df['images'].isnull().sum()} species with no images")
-    df.dropna(subset=['images'], inplace=True)
+    # Remove unwanted species
+    df_species = read_processed(deck, 'species.csv')
+    df_species = df_species[~df_species.index.isin(UNWANTED_SPECIES)]
+
+    # Join everything on the EOL ID in one go, keeping the taxonomic order of the species file
+    with step('join images', rows_in=len(df_species)) as s:
+        df = df_species.join(df_images, how='inner')
+        s.rows_out = len(df)
+    others = []
+    for file in ['species with identification.csv', 'species with translations.csv', 'species with countries.csv']:
+        with step(f'join {file}', rows_in=len(df)) as s:
+            other = read_processed(deck, file)
+            s.info['matched'] = int(df.index.isin(other.index).sum())
+            others.append(other.reindex(df.index))
+            s.rows_out = len(df)
+    df = pd.concat([df] + others, axis=1).reset_index()
+
+    with step('remove bad images', rows_in=len(df)) as s:
+        # The images are only checked when the validate stage was run
+        path = os.path.join('data', 'processed', f'{deck.value['type']} bad images.csv')
+        bad_images = pd.read_csv(path, dtype={'eolID': 'int64', 'url': str, 'reason': str}) if os.path.exists(path) else pd.DataFrame({'eolID': pd.Series(dtype='int64'), 'url': pd.Series(dtype=str)})
+        remove_unwanted_imgs(df, bad_images)
+        # Cards left without images are removed
+        empty = df['images'] == ''
+        print(f"Removing {len(bad_images)} bad images, {empty.sum()} species have none left")
+        df = df[~empty].reset_index(drop=True)
+        s.rows_out = len(df)
+
+    # Images are written in the compact versioned format that the card templates expand
+    with step('compact images', rows_in=len(df)) as s:
+        s.info['characters_before'] = int(df['images'].str.len().sum())
+        df['images'] = df['images'].map(compact_images)
+        s.info['characters_after'] = int(df['images'].str.len().sum())
+        s.rows_out = len(df)
+
+    # Prefer the English names from iNaturalist, capitalized once per unique name
+    codes, names = pd.factorize(df['preferred_common_name'].combine_first(df['English']).fillna(''))
+    df['English'] = names.map(capwords).take(codes)
 
     # Create tags
     df['taxonomy_tag'] = df['countries'].fillna('') + ' ' + df['taxonomy_tag']
     if len(deck.value['taxon_rank']) > 1:
-        df['taxonomy_tag'] = df['taxonomy_tag'] + ' ' + df['rank']
+        df['taxonomy_tag'] = df['taxonomy_tag'] + ' ' + df['rank'].astype(str)
 
-    # Create strings to sort by in Anki
-    df['observations_count'] = df['observations_count'].astype('Int64')
-    create_sort_string(df, 'Taxonomic sort')
-    
-    df.sort_values(by=['observations_count', 'Taxonomic sort'], ascending=[False, True], inplace=True)
-    create_sort_string(df, 'Observations sort')
-    
-    df['rank'] = pd.Categorical(df['rank'], categories=['genus', 'species'], ordered=True)
-    df.sort_values(by=['rank', 'Taxonomic sort'], ascending=[True, True], inplace=True)
+    # Create strings to sort by in Anki, most observed first (unknown counts last)
+    positions = np.arange(len(df))
+    df['Taxonomic sort'] = create_sort_string(positions)
+    observations = df['observations_count'].to_numpy(dtype='float64', na_value=np.nan)
+    observation_order = np.lexsort((positions, np.nan_to_num(-observations, nan=np.inf)))
+    df['Observations sort'] = create_sort_string(np.argsort(observation_order))
+
+    # Order genera before species (other ranks last), keeping the taxonomic order within each rank
+    ranks = pd.Categorical(df['rank'], categories=['genus', 'species'], ordered=True).codes
+    df = df.iloc[np.argsort(np.where(ranks < 0, 2, ranks), kind='stable')]
 
     # Rename and reorder columns
-    df.rename(columns={'canonicalName': 'Scientific', 'eolID': 'EOL ID', 'inaturalistID': 'iNaturalist ID', 'gbifID': 'GBIF ID', 'identification': 'Identification', 'conservation_status': 'Conservation status', 'images': 'Images', 'observations_count': 'Observations', 'taxonomy_tag': 'Tags'}, inplace=True)
+    df = df.rename(columns={'canonicalName': 'Scientific', 'eolID': 'EOL ID', 'inaturalistID': 'iNaturalist ID', 'gbifID': 'GBIF ID', 'identification': 'Identification', 'conservation_status': 'Conservation status', 'images': 'Images', 'observations_count': 'Observations', 'taxonomy_tag': 'Tags'})
     df = df.reindex(columns=COLUMNS)
     
 
-    create_csv(df, deck.value['type'])
+    with step('write csv', rows_in=len(df)):
+        create_csv(df, deck.value['type'])
     print("Done.")
\ No newline at end of file
@@ -1,38 +1,159 @@
 import pandas as pd
 import os
+import sys
+import json
+from taxa import deck_list
+from ingest import iter_input, input_columns
+from instrument import step
+from gbif_counts import CountryCounts
 
 COUNTRY_CODES = {'AD': 'Andorra', 'AE': 'United-Arab-Emirates', 'AF': 'Afghanistan', 'AG': 'Antigua-and-Barbuda', 'AI': 'Anguilla', 'AL': 'Albania', 'AM': 'Armenia', 'AO': 'Angola', 'AQ': 'Antarctica', 'AR': 'Argentina', 'AS': 'American-Samoa', 'AT': 'Austria', 'AU': 'Australia', 'AW': 'Aruba', 'AX': 'Åland-Islands', 'AZ': 'Azerbaijan', 'BA': 'Bosnia-and-Herzegovina', 'BB': 'Barbados', 'BD': 'Bangladesh', 'BE': 'Belgium', 'BF': 'Burkina-Faso', 'BG': 'Bulgaria', 'BH': 'Bahrain', 'BI': 'Burundi', 'BJ': 'Benin', 'BL': 'Saint-Barthélemy', 'BM': 'Bermuda', 'BN': 'Brunei-Darussalam', 'BO': 'Bolivia', 'BQ': 'Bonaire,-Sint-Eustatius-and-Saba', 'BR': 'Brazil', 'BS': 'Bahamas', 'BT': 'Bhutan', 'BV': 'Bouvet-Island', 'BW': 'Botswana', 'BY': 'Belarus', 'BZ': 'Belize', 'CA': 'Canada', 'CC': 'Cocos-(Keeling)-Islands', 'CD': 'Democratic-Republic-of-the-Congo', 'CF': 'Central-African-Republic', 'CG': 'Congo', 'CH': 'Switzerland', 'CI': 'Ivory-Coast', 'CK': 'Cook-Islands', 'CL': 'Chile', 'CM': 'Cameroon', 'CN': 'China', 'CO': 'Colombia', 'CR': 'Costa-Rica', 'CU': 'Cuba', 'CV': 'Cabo-Verde', 'CW': 'Curaçao', 'CX': 'Christmas-Island', 'CY': 'Cyprus', 'CZ': 'Czechia', 'DE': 'Germany', 'DJ': 'Djibouti', 'DK': 'Denmark', 'DM': 'Dominica', 'DO': 'Dominican-Republic', 'DZ': 'Algeria', 'EC': 'Ecuador', 'EE': 'Estonia', 'EG': 'Egypt', 'EH': 'Western-Sahara', 'ER': 'Eritrea', 'ES': 'Spain', 'ET': 'Ethiopia', 'FI': 'Finland', 'FJ': 'Fiji', 'FK': 'Falkland-Islands-(Malvinas)', 'FM': 'Federated-States-of-Micronesia', 'FO': 'Faroe-Islands', 'FR': 'France', 'GA': 'Gabon', 'GB': 'United-Kingdom', 'GD': 'Grenada', 'GE': 'Georgia', 'GF': 'French-Guiana', 'GG': 'Guernsey', 'GH': 'Ghana', 'GI': 'Gibraltar', 'GL': 'Greenland', 'GM': 'Gambia', 'GN': 'Guinea', 'GP': 'Guadeloupe', 'GQ': 'Equatorial-Guinea', 'GR': 'Greece', 'GS': 'South-Georgia-and-the-South-Sandwich-Islands', 'GT': 'Guatemala', 'GU': 'Guam', 'GW': 'Guinea-Bissau', 'GY': 'Guyana', 'HK': 'Hong-Kong', 'HM': 'Heard-Island-and-McDonald-Islands', 'HN': 'Honduras', 'HR': 'Croatia', 'HT': 'Haiti', 'HU': 'Hungary', 'ID': 'Indonesia', 'IE': 'Ireland', 'IL': 'Israel', 'IM': 'Isle-of-Man', 'IN': 'India', 'IO': 'British-Indian-Ocean-Territory', 'IQ': 'Iraq', 'IR': 'Iran', 'IS': 'Iceland', 'IT': 'Italy', 'JE': 'Jersey', 'JM': 'Jamaica', 'JO': 'Jordan', 'JP': 'Japan', 'KE': 'Kenya', 'KG': 'Kyrgyzstan', 'KH': 'Cambodia', 'KI': 'Kiribati', 'KM': 'Comoros', 'KN': 'Saint-Kitts-and-Nevis', 'KP': 'North-Korea', 'KR': 'South-Korea', 'KW': 'Kuwait', 'KY': 'Cayman-Islands', 'KZ': 'Kazakhstan', 'LA': 'Laos', 'LB': 'Lebanon', 'LC': 'Saint-Lucia', 'LI': 'Liechtenstein', 'LK': 'Sri-Lanka', 'LR': 'Liberia', 'LS': 'Lesotho', 'LT': 'Lithuania', 'LU': 'Luxembourg', 'LV': 'Latvia', 'LY': 'Libya', 'MA': 'Morocco', 'MC': 'Monaco', 'MD': 'Moldova', 'ME': 'Montenegro', 'MF': 'Saint-Martin-(French-part)', 'MG': 'Madagascar', 'MH': 'Marshall-Islands', 'MK': 'North-Macedonia', 'ML': 'Mali', 'MM': 'Myanmar', 'MN': 'Mongolia', 'MO': 'Macao', 'MP': 'Northern-Mariana-Islands', 'MQ': 'Martinique', 'MR': 'Mauritania', 'MS': 'Montserrat', 'MT': 'Malta', 'MU': 'Mauritius', 'MV': 'Maldives', 'MW': 'Malawi', 'MX': 'Mexico', 'MY': 'Malaysia', 'MZ': 'Mozambique', 'NA': 'Namibia', 'NC': 'New-Caledonia', 'NE': 'Niger', 'NF': 'Norfolk-Island', 'NG': 'Nigeria', 'NI': 'Nicaragua', 'NL': 'Netherlands', 'NO': 'Norway', 'NP': 'Nepal', 'NR': 'Nauru', 'NU': 'Niue', 'NZ': 'New-Zealand', 'OM': 'Oman', 'PA': 'Panama', 'PE': 'Peru', 'PF': 'French-Polynesia', 'PG': 'Papua-New-Guinea', 'PH': 'Philippines', 'PK': 'Pakistan', 'PL': 'Poland', 'PM': 'Saint-Pierre-and-Miquelon', 'PN': 'Pitcairn', 'PR': 'Puerto-Rico', 'PS': 'Palestine', 'PT': 'Portugal', 'PW': 'Palau', 'PY': 'Paraguay', 'QA': 'Qatar', 'RE': 'Réunion', 'RO': 'Romania', 'RS': 'Serbia', 'RU': 'Russia', 'RW': 'Rwanda', 'SA': 'Saudi-Arabia', 'SB': 'Solomon-Islands', 'SC': 'Seychelles', 'SD': 'Sudan', 'SE': 'Sweden', 'SG': 'Singapore', 'SH': 'Saint-Helena,-Ascension-and-Tristan-da-Cunha', 'SI': 'Slovenia', 'SJ': 'Svalbard-and-Jan-Mayen', 'SK': 'Slovakia', 'SL': 'Sierra-Leone', 'SM': 'San-Marino', 'SN': 'Senegal', 'SO': 'Somalia', 'SR': 'Suriname', 'SS': 'South-Sudan', 'ST': 'Sao-Tome-and-Principe', 'SV': 'El-Salvador', 'SX': 'Sint-Maarten-(Dutch-part)', 'SY': 'Syria', 'SZ': 'Eswatini', 'TC': 'Turks-and-Caicos-Islands', 'TD': 'Chad', 'TF': 'French-Southern-Territories', 'TG': 'Togo', 'TH': 'Thailand', 'TJ': 'Tajikistan', 'TK': 'Tokelau', 'TL': 'Timor-Leste', 'TM': 'Turkmenistan', 'TN': 'Tunisia', 'TO': 'Tonga', 'TR': 'Turkey', 'TT': 'Trinidad-and-Tobago', 'TV': 'Tuvalu', 'TW': 'Taiwan', 'TZ': 'Tanzania', 'UA': 'Ukraine', 'UG': 'Uganda', 'UM': 'United-States-Minor-Outlying-Islands', 'US': 'United-States-of-America', 'UY': 'Uruguay', 'UZ': 'Uzbekistan', 'VA': 'Holy-See', 'VC': 'Saint-Vincent-and-the-Grenadines', 'VE': 'Venezuela', 'VG': 'Virgin-Islands-(British)', 'VI': 'Virgin-Islands-(U.S.)', 'VN': 'Vietnam', 'VU': 'Vanuatu', 'WF': 'Wallis-and-Futuna', 'WS': 'Samoa', 'XK': 'Kosovo', 'XZ': 'International-Waters', 'YE': 'Yemen', 'YT': 'Mayotte', 'ZA': 'South-Africa', 'ZM': 'Zambia', 'ZW': 'Zimbabwe'}
 
-def merge_rows(df):
-    # Remove rows with unknown countries
-    df = df[df['countrycode'] != 'ZZ']
+MIN_OBSERVATIONS = 5
+RARE_TOTAL = 300
+GBIF_COLUMNS = ['taxonkey', 'countrycode', 'observation_count', 'min_gbifid', 'max_gbifid']
+QUERY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query.json')
+DELTA_QUERY_PATH = os.path.join('data', 'input', 'GBIF_delta_query.json')
+TAG_CHUNK_TAXA = 100_000 # Taxa whose tags are rebuilt at a time, so memory does not grow with the export
 
+# Name of a GBIF export: the extracted TSV, or the zip as downloaded (SQL_TSV_ZIP)
+def gbif_input(name='GBIF_output'):
+    return f'{name}.csv' if os.path.exists(os.path.join('data', 'input', f'{name}.csv')) else f'{name}.zip'
+
+# Identifies the version of an export, so the full export is only loaded again when it changes
+def export_signature(name):
+    stat = os.stat(os.path.join('data', 'input', name))
+    return {'name': name, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+# The query of query.json restricted to the occurrences GBIF added after the watermark (the highest occurrence id counted)
+def delta_query(watermark):
+    with open(QUERY_PATH, encoding='utf-8') as f:
+        query = json.load(f)
+    query['sql'] = query['sql'].replace(' GROUP BY ', f' AND gbifid > {watermark} GROUP BY ', 1)
+    return query
+
+# Concat the countries of each taxon into a single tag string (in a dict, a groupby joins a slice of the column per taxon)
+def create_tags(df):
     # Translate to country name
-    df.loc[:, 'countrycode'] = df['countrycode'].map(COUNTRY_CODES)
-    df.loc[:, 'countrycode'] = 'OBS::' + df['countrycode']
-    df = df.rename(columns={'countrycode': 'country'})
+    countries = ('OBS::' + df['countrycode'].astype(object).map(COUNTRY_CODES)).tolist()
+    tags = {}
+    for key, country in zip(df['taxonkey'].tolist(), countries):
+        tags.setdefault(key, []).append(country)
+    keys = sorted(tags)
+    return pd.DataFrame({'taxonkey': pd.array(keys, dtype=df['taxonkey'].dtype), 'countries': [' '.join(tags[key]) for key in keys]})
+
+# Aggregates the export chunk by chunk, keeping only the taxa in taxon_keys.
+# Only rows that can still end up in a tag are kept, so memory is bounded by the output size.
+def merge_rows(chunks, taxon_keys):
+    totals = pd.Series(dtype='int64')
+    df = None
+    for chunk in chunks:
+        # Remove rows with unknown countries
+        chunk = chunk[chunk['taxonkey'].isin(taxon_keys) & (chunk['countrycode'] != 'ZZ')]
 
-    # Group by species and calculate total observations
-    df['total_observations'] = df.groupby('taxonkey')['observation_count'].transform('sum')
+        # Running total observations of each species
+        totals = totals.add(chunk.groupby('taxonkey')['observation_count'].sum(), fill_value=0)
 
-    # Keep only countries with at least 5 observations (since 2000) or if the species is rare globally
-    df = df[(df['observation_count'] >= 5) | (df['total_observations'] <= 300)]
+        # Keep only countries with at least 5 observations (since 2000) or if the species is rare globally
+        df = pd.concat([df, chunk]) if df is not None else chunk
+        df = df[(df['observation_count'] >= MIN_OBSERVATIONS) | (df['taxonkey'].map(totals) <= RARE_TOTAL)]
 
-    # Concat the countries into a single row
-    df = df.groupby('taxonkey')['country'].apply(lambda x: ' '.join(x)).reset_index()
-    df = df.rename(columns={'country': 'countries'})
+    if df is None:
+        return pd.DataFrame(columns=['taxonkey', 'countries'])
+    return create_tags(df)
 
-    
-    return df
+# Rebuilds the tags of the given taxa (all taxa of the counts without them) a chunk of taxa at a time,
+# returns the number of taxa with a tag
+def update_tags(counts, keys=None):
+    chunks = counts.key_chunks(TAG_CHUNK_TAXA) if keys is None else (keys[i:i + TAG_CHUNK_TAXA] for i in range(0, len(keys), TAG_CHUNK_TAXA))
+    tagged = 0
+    for chunk in chunks:
+        tags = create_tags(counts.tag_rows(chunk, MIN_OBSERVATIONS, RARE_TOTAL))
+        counts.store_tags(chunk, tags)
+        tagged += len(tags)
+    return tagged
+
+# Brings the count store up to date: a new full export replaces all counts and tags, and a delta export is added
+# once, recomputing the tags of only the taxa it counts
+def update_counts(counts):
+    full = gbif_input()
+    if os.path.exists(os.path.join('data', 'input', full)) and export_signature(full) != counts.get('source'):
+        with step(f'load {full}') as s:
+            counts.replace(iter_input(full, input_columns(full)), export_signature(full))
+            s.rows_out = update_tags(counts)
+
+    delta = gbif_input('GBIF_delta')
+    if os.path.exists(os.path.join('data', 'input', delta)) and export_signature(delta) != counts.get('delta'):
+        if counts.watermark is None:
+            print(f"{full} has no occurrence ids (it was downloaded with an earlier query.json), so {delta} cannot be merged without counting occurrences twice. Download a full export with {QUERY_PATH} to use deltas.")
+            return
+        if input_columns(delta) != GBIF_COLUMNS:
+            print(f"{delta} has no occurrence ids, skipping it. Download it with the query of python src/countries.py query")
+            return
+        with step(f'merge {delta}') as s:
+            keys = counts.merge(iter_input(delta, GBIF_COLUMNS), export_signature(delta))
+            if keys is None:
+                print(f"{delta} has occurrences that are already counted, skipping it")
+                return
+            s.rows_in, s.rows_out = len(keys), update_tags(counts, sorted(keys))
+            print(f"Merged {delta}: {len(keys)} taxa updated, {s.rows_out} with country tags")
 
 # Get countries where each species has been observed at least 5 times since 2000 (or is rare globally)
-def get_countries(deck):
+# The counts are kept in data/cache/gbif_counts.sqlite, so a refresh only downloads and merges a delta export
+def get_countries(decks):
     print("Getting countries...")
-    df = pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} species.csv'), usecols=['eolID', 'gbifID'])
-    df_countries = pd.read_csv(os.path.join('data', 'input', 'GBIF_output.csv'), sep='\t', keep_default_na=False, na_values=[''], dtype={'taxonkey': int, 'countrycode': str, 'observation_count': int})
-    
-    df_countries = merge_rows(df_countries)
-
-    df = df.merge(df_countries, left_on='gbifID', right_on='taxonkey', how='left')
-    df.drop(columns=['taxonkey', 'gbifID'], inplace=True)
-    df.to_csv(os.path.join('data', 'processed', f'{deck.value['type']} species with countries.csv'), index=False)
\ No newline at end of file
+    decks = deck_list(decks)
+    species = {deck: pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} species.csv'), usecols=['eolID', 'gbifID']) for deck in decks}
+
+    with CountryCounts() as counts:
+        update_counts(counts)
+
+        for deck, df in species.items():
+            with step(f"{deck.value['type']} merge", rows_in=len(df)) as s:
+                df = df.merge(counts.tags(df['gbifID'].unique()), left_on='gbifID', right_on='taxonkey', how='left')
+                s.rows_out = len(df)
+            df.drop(columns=['taxonkey', 'gbifID'], inplace=True)
+            df.to_csv(os.path.join('data', 'processed', f'{deck.value['type']} species with countries.csv'), index=False)
+
+
+# Writes the query for a delta export of the occurrences added since the last export that was loaded
+def write_delta_query():
+    with CountryCounts() as counts:
+        watermark = counts.watermark
+    if watermark is None:
+        print(f"The loaded GBIF export has no occurrence ids (or none was loaded), so there is no watermark to start a delta after. Download a full export with {QUERY_PATH} first")
+        return
+    with open(DELTA_QUERY_PATH, 'w', encoding='utf-8') as f:
+        json.dump(delta_query(watermark), f, indent=2)
+    print(f"Wrote {DELTA_QUERY_PATH} for the occurrences after id {watermark}. Save the download as data/input/GBIF_delta.zip")
+
+# Checks the incremental counts offline: loads the full and delta exports of data/input (e.g. the synthetic ones of
+# the benchmark) into a temporary store and compares its tags with merge_rows() over the counts of both exports summed
+def check_delta():
+    import tempfile
+    full, delta = gbif_input(), gbif_input('GBIF_delta')
+    with tempfile.TemporaryDirectory() as directory, CountryCounts(os.path.join(directory, 'counts.sqlite')) as counts:
+        counts.replace(iter_input(full, input_columns(full)), export_signature(full))
+        update_tags(counts)
+        if counts.watermark is None or input_columns(delta) != GBIF_COLUMNS:
+            print(f"{full} and {delta} need occurrence ids to be merged, download them with the current queries")
+            return
+        keys = counts.merge(iter_input(delta, GBIF_COLUMNS))
+        if keys is None:
+            print(f"{delta} overlaps {full}, it was not merged")
+            return
+        update_tags(counts, sorted(keys))
+
+        summed = pd.concat([*iter_input(full, GBIF_COLUMNS[:3]), *iter_input(delta, GBIF_COLUMNS[:3])])
+        summed = summed.groupby(['taxonkey', 'countrycode'], observed=True, as_index=False)['observation_count'].sum()
+        taxon_keys = summed['taxonkey'].unique()
+        # Tags are compared as sets of countries, the order of the countries in a tag is not kept
+        expected = merge_rows([summed], set(taxon_keys)).set_index('taxonkey')['countries'].str.split().map(frozenset)
+        stored = counts.tags(taxon_keys).set_index('taxonkey')['countries'].str.split().map(frozenset)
+    differ = (expected.reindex(stored.index.union(expected.index)) != stored.reindex(stored.index.union(expected.index))).sum()
+    print(f"{len(keys)} taxa in {delta}, {len(stored)} taxa with tags, {differ} differ from aggregating both exports at once")
+
+
+# Usage: python src/countries.py query (writes the delta query) or python src/countries.py check
+if __name__ == '__main__':
+    {'query': write_delta_query, 'check': check_delta}[sys.argv[1]]()
@@ -0,0 +1,62 @@
+import os
+import uuid
+import hashlib
+import sqlite3
+from instrument import RUN_VARIABLE
+
+CACHE_PATH = os.path.join('data', 'cache', 'descriptions.sqlite')
+KEEP_RUNS = 5 # Evict descriptions that were not used in the last 5 pipeline runs
+LOCK_TIMEOUT = 60 # Seconds to wait for the processes of the other decks writing the cache
+
+# Persistent cache of cleaned descriptions keyed by a hash of (source, cleaner version, parser, raw text).
+# The decks of a pipeline run share its run number (named by RUN_VARIABLE), outside the pipeline every cache opened is a run.
+class DescriptionCache:
+    def __init__(self, version, path=CACHE_PATH, keep_runs=KEEP_RUNS, run_name=None):
+        self.version = version
+        self.keep_runs = keep_runs
+        self.hits = 0
+        self.misses = 0
+        run_name = run_name or os.environ.get(RUN_VARIABLE) or uuid.uuid4().hex
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS descriptions (key BLOB PRIMARY KEY, cleaned TEXT, last_run INTEGER NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS pipeline_runs (name TEXT PRIMARY KEY, run INTEGER NOT NULL)')
+            self.connection.execute('INSERT OR IGNORE INTO pipeline_runs (name, run) SELECT ?, COALESCE(MAX(run), 0) + 1 FROM pipeline_runs', (run_name,))
+            self.run = self.connection.execute('SELECT run FROM pipeline_runs WHERE name = ?', (run_name,)).fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM descriptions WHERE last_run <= ?', (self.run - self.keep_runs,))
+            self.connection.execute('DELETE FROM pipeline_runs WHERE run <= ?', (self.run - self.keep_runs,))
+        self.connection.close()
+
+    def key(self, source, parser, text):
+        return hashlib.sha256(f'{source}\0{self.version}\0{parser}\0{text}'.encode()).digest()
+
+    # Returns the cached cleaned descriptions of the texts that have one and marks them as used
+    def lookup(self, source, parser, texts):
+        keys = {self.key(source, parser, text): text for text in texts}
+        found = {}
+        key_list = list(keys)
+        for i in range(0, len(key_list), 900):
+            chunk = key_list[i:i + 900]
+            rows = self.connection.execute(f'SELECT key, cleaned FROM descriptions WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+            found.update(rows)
+        with self.connection:
+            self.connection.executemany('UPDATE descriptions SET last_run = ? WHERE key = ?', [(self.run, key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return {keys[key]: cleaned for key, cleaned in found.items()}
+
+    def store(self, source, parser, cleaned):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO descriptions (key, cleaned, last_run) VALUES (?, ?, ?)',
+                                        [(self.key(source, parser, text), result, self.run) for text, result in cleaned.items()])
@@ -0,0 +1,43 @@
+# Columns of the deck csv and fields of the Species note type. Only plain lists, so the tools that read
+# deck files (e.g. sort.py) do not import pandas or the stages.
+
+# Common name fields with the codes of their language in vernacularnames.csv
+LANGUAGES = [
+    ('English', ['eng']),
+    ('Arabic', ['ara']),
+    ('Azerbaijani', ['aze']),
+    ('Bulgarian', ['bul']),
+    ('Catalan', ['cat']),
+    ('Croatian', ['hrv']),
+    ('Czech', ['cze']),
+    ('Danish', ['dan']),
+    ('Dutch', ['dut']),
+    ('Estonian', ['est']),
+    ('Finnish', ['fin']),
+    ('French', ['fre']),
+    ('German', ['ger']),
+    ('Hebrew', ['heb']),
+    ('Hungarian', ['hun']),
+    ('Indonesian', ['ind']),
+    ('Italian', ['ita']),
+    ('Japanese', ['jpn']),
+    ('Lithuanian', ['lit']),
+    ('Malay', ['may']),
+    ('Norwegian', ['nor', 'nob']),
+    ('Persian', ['per']),
+    ('Polish', ['pol']),
+    ('Portuguese', ['por']),
+    ('Russian', ['rus']),
+    ('Serbian', ['srp']),
+    ('Slovak', ['slo']),
+    ('Spanish', ['spa', 'sp']),
+    ('Swedish', ['swe']),
+    ('Thai', ['tha']),
+    ('Turkish', ['tur']),
+    ('Ukrainian', ['ukr']),
+    ('Vietnamese', ['vie']),
+]
+
+COLUMNS = ['Scientific', 'EOL ID', 'iNaturalist ID', 'GBIF ID', 'Conservation status', 'Observations', 'Taxonomic sort', 'Observations sort', 'Identification', 'Images', 'Tags']
+COLUMNS.extend([language for language, _ in LANGUAGES])
+FIELDS = [column for column in COLUMNS if column != 'Tags']
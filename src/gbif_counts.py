@@ -0,0 +1,121 @@
+import os
+import json
+import sqlite3
+import pandas as pd
+
+STORE_PATH = os.path.join('data', 'cache', 'gbif_counts.sqlite')
+
+
+# Persistent observation counts per taxon and country, loaded from a full GBIF export and the delta exports
+# merged since. Exports carry the range of GBIF occurrence ids each row counts (min_gbifid, max_gbifid), and the
+# highest id merged is the watermark the next delta query starts after, so every occurrence is counted once.
+# A full export without the ids (made with an earlier query.json) is loaded without a watermark, and deltas
+# can only be merged after a full export with the ids.
+# The country tags of every taxon are stored next to the counts and only recomputed for the taxa that changed.
+class CountryCounts:
+    def __init__(self, path=STORE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS counts (taxonkey INTEGER NOT NULL, countrycode TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (taxonkey, countrycode)) WITHOUT ROWID')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS tags (taxonkey INTEGER PRIMARY KEY, countries TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self.connection.execute('CREATE TEMP TABLE selected (taxonkey INTEGER PRIMARY KEY)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    # Highest GBIF occurrence id counted (None before the first full export with the ids)
+    @property
+    def watermark(self):
+        return self.get('watermark')
+
+    # Adds the rows of an export to the counts, returns the taxon keys and the highest occurrence id
+    def _add(self, chunks, after=None):
+        keys, watermark = set(), self.watermark
+        for chunk in chunks:
+            # Rows with unknown countries are not counted
+            chunk = chunk[chunk['countrycode'].notna() & (chunk['countrycode'] != 'ZZ')]
+            if chunk.empty:
+                continue
+            if after is not None and chunk['min_gbifid'].min() <= after:
+                return None, None
+            self.connection.executemany('INSERT INTO counts (taxonkey, countrycode, count) VALUES (?, ?, ?) ON CONFLICT (taxonkey, countrycode) DO UPDATE SET count = count + excluded.count',
+                                        zip(chunk['taxonkey'].astype('int64').tolist(), chunk['countrycode'].astype(str).tolist(), chunk['observation_count'].astype('int64').tolist()))
+            keys.update(chunk['taxonkey'].astype('int64').tolist())
+            if 'max_gbifid' in chunk:
+                watermark = max(watermark or 0, int(chunk['max_gbifid'].max()))
+        return keys, watermark
+
+    # Replaces all counts with those of a full export (chunks with the columns of query.json).
+    # source identifies the export, so it is only loaded again when it changes.
+    def replace(self, chunks, source):
+        with self.connection:
+            self.connection.execute('DELETE FROM counts')
+            self.connection.execute('DELETE FROM tags')
+            self.connection.execute('DELETE FROM meta')
+            _, watermark = self._add(chunks)
+            self._set('source', source)
+            self._set('watermark', watermark)
+
+    # Adds the counts of a delta export in one transaction and returns the taxon keys it changed.
+    # A delta with occurrences at or below the watermark is already counted (or overlaps the counts)
+    # and is left out, returning None. source identifies the last delta merged.
+    def merge(self, chunks, source=None):
+        if self.watermark is None:
+            raise ValueError('Delta exports can only be merged after a full export with occurrence ids')
+        with self.connection:
+            keys, watermark = self._add(chunks, after=self.watermark)
+            if keys is None:
+                self.connection.rollback()
+                return None
+            self._set('watermark', watermark)
+            self._set('delta', source)
+        return keys
+
+    def _select(self, keys):
+        self.connection.execute('DELETE FROM selected')
+        self.connection.executemany('INSERT OR IGNORE INTO selected (taxonkey) VALUES (?)', ((int(key),) for key in keys))
+
+    # The taxon keys of the counts in ascending chunks
+    def key_chunks(self, size):
+        last = None
+        while True:
+            rows = self.connection.execute('SELECT DISTINCT taxonkey FROM counts WHERE taxonkey > COALESCE(?, -1) ORDER BY taxonkey LIMIT ?', (last, size))
+            keys = [key for (key,) in rows]
+            if not keys:
+                return
+            yield keys
+            last = keys[-1]
+
+    # The (taxonkey, countrycode) rows of the given taxa that make a country tag: countries with at least
+    # min_observations, or every country of taxa with at most rare_total observations
+    def tag_rows(self, keys, min_observations, rare_total):
+        self._select(keys)
+        query = 'SELECT c.taxonkey, c.countrycode FROM counts c JOIN (SELECT taxonkey, SUM(count) AS total FROM counts WHERE taxonkey IN (SELECT taxonkey FROM selected) GROUP BY taxonkey) t ON t.taxonkey = c.taxonkey WHERE c.count >= ? OR t.total <= ? ORDER BY c.taxonkey, c.countrycode'
+        return pd.read_sql_query(query, self.connection, params=(min_observations, rare_total), dtype={'taxonkey': 'int64', 'countrycode': 'category'})
+
+    # Stores the tags (taxonkey, countries) of the given taxa, the ones that no longer have a tag are removed
+    def store_tags(self, keys, tags):
+        with self.connection:
+            self._select(keys)
+            self.connection.execute('DELETE FROM tags WHERE taxonkey IN (SELECT taxonkey FROM selected)')
+            self.connection.executemany('INSERT INTO tags (taxonkey, countries) VALUES (?, ?)', zip(tags['taxonkey'].astype('int64').tolist(), tags['countries'].tolist()))
+
+    # Country tags of the given taxon keys (taxonkey, countries), taxa without a tag are left out
+    def tags(self, keys):
+        self._select(keys)
+        return pd.read_sql_query('SELECT taxonkey, countries FROM tags WHERE taxonkey IN (SELECT taxonkey FROM selected)', self.connection, dtype={'taxonkey': 'int64'})
@@ -1,7 +1,19 @@
 import os
+import sys
 import pandas as pd
 import re
 from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import chain, repeat
+from ingest import read_input
+from description_cache import DescriptionCache
+from instrument import step
+
+# Bump when a cleaner changes its output, so cached descriptions are cleaned again
+CLEANER_VERSION = 2
+OLD_ADW_LINK = 'http://animaldiversity.ummz.umich.edu/site'
+CHUNK_SIZE = 500
 
 # Remove references like (1), (2), etc.
 def remove_arkive_refs(text):
@@ -22,12 +34,12 @@ def remove_traits(text):
 def replace_line_breaks(text):
     return text.replace('\\n', '<br>') if not pd.isnull(text) else None
 
-def replace_old_links(text):
+def replace_old_links(text, parser='html.parser'):
     if pd.isnull(text):
         return None
-    soup = BeautifulSoup(text, 'html.parser')
+    soup = BeautifulSoup(text, parser)
     for a in soup.find_all('a'):
-        if a.get('href', '').startswith('http://animaldiversity.ummz.umich.edu/site'):
+        if a.get('href', '').startswith(OLD_ADW_LINK):
             a.decompose()
     return str(soup)
 
@@ -67,8 +79,8 @@ def add_dots(text):
     return re.sub(r'\.?\s?(<\/[^>]+>)$', r'...\1', text)
 
 # Extract the "Description" section from the Wikipedia text
-def extract_wiki_section(html):
-    soup = BeautifulSoup(str(html), 'html.parser')
+def extract_wiki_section(html, parser='html.parser'):
+    soup = BeautifulSoup(str(html), parser)
     description_header = find_description_header(soup)
 
     if not description_header:
@@ -95,8 +107,8 @@ def extract_wiki_section(html):
 
     return "".join(descriptions)
 
-def extract_first_paragraphs(html):
-    soup = BeautifulSoup(str(html), 'html.parser')
+def extract_first_paragraphs(html, parser='html.parser'):
+    soup = BeautifulSoup(str(html), parser)
     paragraphs = []
     for paragraph in soup.find_all('p'):
         if paragraph.find(['img', 'audio', 'iframe']):
@@ -109,14 +121,14 @@ def extract_first_paragraphs(html):
     
     return "".join(paragraphs)
 
-def clean_html(text):
+def clean_html(text, parser='html.parser'):
     if pd.isnull(text):
         return None
     
     # Remove text before the first tag
     text = re.sub(r'^[^<]*<', '<', text)
 
-    soup = BeautifulSoup(text, 'html.parser')
+    soup = BeautifulSoup(text, parser)
     for tag in ['img', 'video', 'audio', 'iframe']:
         for match in soup.find_all(tag):
             match.decompose()
@@ -130,47 +142,130 @@ def add_source(text, source):
     return re.sub(r'(\w+)$', fr'\1 ({source})', text)
 
 
-# Gets identification information from each resource page
-def get_identification(deck):
-    print('Getting identification information...')
+def clean_arkive(text, parser='html.parser'):
+    return wrap_in_p_tag(remove_arkive_refs(text))
+
+# Parses the ADW description once for all of its transforms
+def clean_adw(text, parser='html.parser'):
+    if pd.isnull(text):
+        return None
+    soup = BeautifulSoup(text, parser)
+    for p in soup.find_all('p'):
+        if p.find('strong'):
+            p.decompose()
+    html = str(soup)
+    text = remove_adw_amphibia_refs(html)
+    # A removed reference can cross an inline tag, e.g. '(see <em>Smith 2000)</em>', and leave an end tag that parsing drops
+    removed_tags = text.count('<') != html.count('<')
+    text = replace_line_breaks(text)
+
+    # Parsing again only changes more than the new <br> tags if there are old links to remove or tags were cut
+    if OLD_ADW_LINK in text or removed_tags:
+        return replace_old_links(text, parser)
+    return text.replace('<br>', '<br/>')
+
+def clean_fishbase(text, parser='html.parser'):
+    return wrap_in_p_tag(remove_fishbase_refs(text))
+
+def clean_amphibiaweb(text, parser='html.parser'):
+    return remove_adw_amphibia_refs(extract_first_paragraphs(text, parser))
+
+# Cleaning of each description source, the summary is the Wikipedia fallback
+CLEANERS = {
+    'arkiveID': clean_arkive,
+    'adwID': clean_adw,
+    'fishbaseID': clean_fishbase,
+    'wikipediaID': extract_wiki_section,
+    'amphibiawebID': clean_amphibiaweb,
+    'summary': clean_html,
+}
+
+def clean_chunk(source, texts, parser):
+    return [CLEANERS[source](text, parser) for text in texts]
+
+# Cleans each unique description once, spread over the processes of the executor in chunks
+# Descriptions found in the cache are not cleaned again
+def clean_descriptions(series, source, executor=None, parser='html.parser', cache=None):
+    with step(f'clean {source}', rows_in=int(series.notna().sum())) as s:
+        unique = series.dropna().unique()
+        cached = cache.lookup(source, parser, unique) if cache is not None else {}
+        unique = [text for text in unique if text not in cached]
+
+        chunks = [unique[i:i + CHUNK_SIZE] for i in range(0, len(unique), CHUNK_SIZE)]
+        if executor is None:
+            results = [clean_chunk(source, chunk, parser) for chunk in chunks]
+        else:
+            results = executor.map(clean_chunk, repeat(source), chunks, repeat(parser))
+        cleaned = dict(zip(unique, chain.from_iterable(results)))
+        if cache is not None:
+            cache.store(source, parser, cleaned)
+        s.info.update(cleaned=len(cleaned), cache_hits=len(cached))
+        cleaned.update(cached)
+
+        # Missing descriptions get whatever the cleaner returns for them (None or '')
+        result = series.map(cleaned).where(series.notna(), CLEANERS[source](float('nan'), parser))
+        # Descriptions that are empty after cleaning count as dropped
+        s.rows_out = int((result[series.notna()].fillna('') != '').sum())
+    return result
+
+
+# Loads the raw descriptions of each resource next to the species
+def load_descriptions(deck):
     cols = ['arkiveID', 'adwID', 'fishbaseID', 'wikipediaID', 'amphibiawebID']
-    resource_names = ['Arkive', 'Animal Diversity Web', 'FishBase', 'Wikipedia', 'AmphibiaWeb']
     df_species = pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} species.csv'), usecols=['eolID'] + cols, dtype=object)
     
     # Select only the rows with the desired section
-    def load_and_filter_df(file_path, term, section_column="CVterm", further_info_column=True):
+    def load_and_filter_df(name, term, section_column="CVterm", further_info_column=True):
         usecols = ['taxonID', section_column, 'description']
         if further_info_column:
             usecols.append('furtherInformationURL')
-        df = pd.read_csv(file_path, sep='\t', usecols=usecols, dtype=object)
-        return df[df[section_column] == term]
+        with step(f'read {name}') as s:
+            df = read_input(name, usecols, where={section_column: term})
+            s.rows_out = len(df)
+        return df
 
-    df_arkive = load_and_filter_df(os.path.join('data', 'input', 'arkive', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#Description', section_column='title', further_info_column=False)
-    df_adw = load_and_filter_df(os.path.join('data', 'input', 'animal_diversity_web', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#Morphology')
-    df_fishbase = load_and_filter_df(os.path.join('data', 'input', 'fishbase', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#DiagnosticDescription')
-    df_wikipedia = load_and_filter_df(os.path.join('data', 'input', 'wikipedia', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#Description')
-    df_wikipedia_summary = load_and_filter_df(os.path.join('data', 'input', 'wikipedia', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#TaxonBiology')
-    df_amphibiaweb = load_and_filter_df(os.path.join('data', 'input', 'amphibia_web', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#GeneralDescription')
+    df_arkive = load_and_filter_df(os.path.join('arkive', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#Description', section_column='title', further_info_column=False)
+    df_adw = load_and_filter_df(os.path.join('animal_diversity_web', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#Morphology')
+    df_fishbase = load_and_filter_df(os.path.join('fishbase', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#DiagnosticDescription')
+    # Read the two Wikipedia sections in one pass
+    df_wikipedia_all = load_and_filter_df(os.path.join('wikipedia', 'media_resource.tab'), ['http://rs.tdwg.org/ontology/voc/SPMInfoItems#Description', 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#TaxonBiology'])
+    df_wikipedia = df_wikipedia_all[df_wikipedia_all['CVterm'] == 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#Description']
+    df_wikipedia_summary = df_wikipedia_all[df_wikipedia_all['CVterm'] == 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#TaxonBiology']
+    df_amphibiaweb = load_and_filter_df(os.path.join('amphibia_web', 'media_resource.tab'), 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#GeneralDescription')
 
 
     # Merge into one dataframe
     df_merged = df_species
     dfs = [df_arkive, df_adw, df_fishbase, df_wikipedia, df_amphibiaweb]
     for df, suffix in zip(dfs, cols):
-        df_merged = df_merged.merge(df, left_on=suffix, right_on='taxonID', how='left', suffixes=('', f'_{suffix}'))
-        df_merged = df_merged.rename(columns={'description': f'description_{suffix}', 'furtherInformationURL': f'url_{suffix}'})
+        with step(f'merge {suffix}', rows_in=len(df_merged)) as s:
+            df_merged = df_merged.merge(df, left_on=suffix, right_on='taxonID', how='left', suffixes=('', f'_{suffix}'))
+            df_merged = df_merged.rename(columns={'description': f'description_{suffix}', 'furtherInformationURL': f'url_{suffix}'})
+            s.rows_out = len(df_merged)
+
+    # Wikipedia summary to fill missing Wikipedia descriptions
+    df_merged = df_merged.merge(df_wikipedia_summary, left_on='wikipediaID', right_on='taxonID', how='left', suffixes=('', '_summary'))
+    return df_merged.rename(columns={'description': 'description_summary'})
+
+
+# Gets identification information from each resource page
+# Descriptions are cleaned in parallel processes (workers=1 cleans them in this process)
+def get_identification(deck, workers=None, parser='html.parser'):
+    print('Getting identification information...')
+    cols = ['arkiveID', 'adwID', 'fishbaseID', 'wikipediaID', 'amphibiawebID']
+    resource_names = ['Arkive', 'Animal Diversity Web', 'FishBase', 'Wikipedia', 'AmphibiaWeb']
+    with step('load descriptions') as s:
+        df_merged = load_descriptions(deck)
+        s.rows_out = len(df_merged)
 
     # Clean up the descriptions
-    df_merged['description_arkiveID'] = df_merged['description_arkiveID'].apply(remove_arkive_refs).apply(wrap_in_p_tag)
-    df_merged['description_adwID'] = df_merged['description_adwID'].apply(remove_traits).apply(remove_adw_amphibia_refs).apply(replace_line_breaks).apply(replace_old_links)
-    df_merged['description_fishbaseID'] = df_merged['description_fishbaseID'].apply(remove_fishbase_refs).apply(wrap_in_p_tag)
-    df_merged['description_wikipediaID'] = df_merged['description_wikipediaID'].apply(extract_wiki_section)
-    df_merged['description_amphibiawebID'] = df_merged['description_amphibiawebID'].apply(extract_first_paragraphs).apply(remove_adw_amphibia_refs)
+    with ProcessPoolExecutor(workers) if workers != 1 else nullcontext() as executor, DescriptionCache(CLEANER_VERSION) as cache:
+        for source in cols + ['summary']:
+            df_merged[f'description_{source}'] = clean_descriptions(df_merged[f'description_{source}'], source, executor, parser, cache)
+        print(f"Cleaned {cache.misses} descriptions, {cache.hits} from cache")
 
     # Fill missing Wikipedia descriptions with the summary
-    df_merged = df_merged.merge(df_wikipedia_summary, left_on='wikipediaID', right_on='taxonID', how='left', suffixes=('', '_summary'))
-    df_merged['description'] = df_merged['description'].apply(clean_html)
-    df_merged['description_wikipediaID'] = df_merged['description_wikipediaID'].combine_first(df_merged['description'])
+    df_merged['description_wikipediaID'] = df_merged['description_wikipediaID'].combine_first(df_merged['description_summary'])
 
 
     # Remove oldid from wikipedia urls
@@ -193,4 +288,40 @@ def get_identification(deck):
     print(f"Taxa with identification info: {(df_merged['identification'] != '').sum()} / {len(df_merged)}")
 
     df_merged = df_merged.reindex(columns=['eolID', 'identification'])
-    df_merged.to_csv(os.path.join('data', 'processed', f'{deck.value['type']} species with identification.csv'), index=False)
\ No newline at end of file
+    df_merged.to_csv(os.path.join('data', 'processed', f'{deck.value['type']} species with identification.csv'), index=False)
+
+
+# The original chains of cleaning functions, used to check the cleaning pipeline
+REFERENCE_CLEANERS = {
+    'arkiveID': [remove_arkive_refs, wrap_in_p_tag],
+    'adwID': [remove_traits, remove_adw_amphibia_refs, replace_line_breaks, replace_old_links],
+    'fishbaseID': [remove_fishbase_refs, wrap_in_p_tag],
+    'wikipediaID': [extract_wiki_section],
+    'amphibiawebID': [extract_first_paragraphs, remove_adw_amphibia_refs],
+    'summary': [clean_html],
+}
+
+# Checks that the cleaning pipeline gives exactly the same output as the original functions
+def verify_cleaning(deck, workers=None, parser='html.parser'):
+    df_merged = load_descriptions(deck)
+    mismatches = 0
+    with ProcessPoolExecutor(workers) if workers != 1 else nullcontext() as executor:
+        for source, functions in REFERENCE_CLEANERS.items():
+            series = df_merged[f'description_{source}']
+            expected = series
+            for function in functions:
+                expected = expected.apply(function)
+            actual = clean_descriptions(series, source, executor, parser)
+
+            different = [i for i, (a, b) in enumerate(zip(expected, actual)) if not (a == b or pd.isnull(a) and pd.isnull(b))]
+            mismatches += len(different)
+            print(f"{source}: {len(different)} / {len(series)} different")
+            for i in different[:3]:
+                print(f"  expected: {expected.iloc[i]!r}\n  actual:   {actual.iloc[i]!r}")
+    return mismatches == 0
+
+
+# Usage: python src/identification.py <deck> [parser], e.g. python src/identification.py ANIMALS lxml
+if __name__ == '__main__':
+    from taxa import Deck
+    sys.exit(0 if verify_cleaning(Deck[sys.argv[1]], parser=sys.argv[2] if len(sys.argv) > 2 else 'html.parser') else 1)
\ No newline at end of file
@@ -0,0 +1,89 @@
+import os
+import re
+import sys
+
+# Compact format of the Images field of the deck, expanded by the card templates (expand_images in front.html and back.html).
+# Version 1 (the processed files and decks built before) holds every image as '<img src="..." srcset="...">|attribution|license'.
+# Version 2 starts with the version and the attributions of the note, which are often repeated, followed by one entry per image:
+#   v2|Observer 161|Observer 181;;160||6;;161|0|0;;181.png|1|2
+# An entry is the photo id (prefixed with the code of its host, suffixed with the extension when it is not jpg),
+# the index of its attribution (empty without one) and the index of its license code.
+# Images that do not fit the format are kept as version 1 entries, which the templates also read.
+# Changing the format means a new version and the templates expanding it next to the older ones.
+
+FIELD_VERSION = 'v2'
+PHOTO_WIDTHS = {'small': 240, 'medium': 500, 'large': 1024} # Longest side of each iNaturalist photo variant
+PHOTO_HOSTS = {'': 'https://inaturalist-open-data.s3.amazonaws.com/photos/', 's': 'https://static.inaturalist.org/photos/'}
+LICENSE_CODES = ['cc-by', 'cc-by-nc', 'cc-by-sa', 'cc-by-nd', 'cc-by-nc-sa', 'cc-by-nc-nd', 'cc0', 'pd', 'gfdl']
+DEFAULT_EXTENSION = 'jpg'
+PHOTO = re.compile(r'<img src="(.*/photos/)(\d+)/large\.(\w+)"')
+COMPACT_PHOTO = re.compile(r'([a-z]?)(\d+)(?:\.(\w+))?')
+
+HOST_CODES = {host: code for code, host in PHOTO_HOSTS.items()}
+
+
+# URLs of the photo variants. Results cached before they were requested only have large_url,
+# the other variants are at the same address with the size in the file name.
+def photo_urls(photo):
+    return {size: photo.get(f'{size}_url') or photo['large_url'].replace('/large.', f'/{size}.') for size in PHOTO_WIDTHS}
+
+# The srcset lets the templates load the variant that fits where the image is shown
+def image_tag(urls):
+    srcset = ', '.join(f'{url} {PHOTO_WIDTHS[size]}w' for size, url in urls.items())
+    return f'<img src="{urls["large"]}" srcset="{srcset}">'
+
+def photo_html(base, extension):
+    return image_tag({size: f'{base}{size}.{extension}' for size in PHOTO_WIDTHS})
+
+# Version 2 entry of an image, adding its attribution to attributions (None if it has to stay a version 1 entry)
+def compact_image(image, attributions):
+    match = PHOTO.match(image)
+    parts = image.split('|')
+    if not match or match.group(1) not in HOST_CODES or len(parts) != 3 or parts[2] not in LICENSE_CODES:
+        return None
+    host, photo_id, extension = match.groups()
+    # Only images that expand to exactly the same HTML, e.g. not photos with variants at other addresses
+    if parts[0] != photo_html(f'{host}{photo_id}/', extension):
+        return None
+    photo = HOST_CODES[host] + photo_id + ('' if extension == DEFAULT_EXTENSION else f'.{extension}')
+    attribution = str(attributions.setdefault(parts[1], len(attributions))) if parts[1] else ''
+    return f'{photo}|{attribution}|{LICENSE_CODES.index(parts[2])}'
+
+def compact_images(images):
+    if not images:
+        return images
+    attributions = {}
+    entries = [compact_image(image, attributions) or image for image in images.split(';;')]
+    return ';;'.join(['|'.join([FIELD_VERSION, *attributions])] + entries)
+
+# Version 1 field of any version, as the templates expand it
+def expand_images(field):
+    images = field.split(';;')
+    if not images[0].startswith(FIELD_VERSION):
+        return field
+    attributions = images[0].split('|')[1:]
+    expanded = []
+    for image in images[1:]:
+        if image.startswith('<img'):
+            expanded.append(image)
+            continue
+        photo, attribution, license_code = image.split('|')
+        host, photo_id, extension = COMPACT_PHOTO.fullmatch(photo).groups()
+        html = photo_html(f'{PHOTO_HOSTS[host]}{photo_id}/', extension or DEFAULT_EXTENSION)
+        expanded.append(f'{html}|{attributions[int(attribution)] if attribution else ""}|{LICENSE_CODES[int(license_code)]}')
+    return ';;'.join(expanded)
+
+
+# Checks that the Images of a processed file expand back to exactly the same field, and prints the space saved
+# Usage: python src/image_field.py <deck>, e.g. python src/image_field.py ANIMALS
+if __name__ == '__main__':
+    import pandas as pd
+    from taxa import Deck
+    deck = Deck[sys.argv[1]]
+    images = pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} species with images.csv'), usecols=['images'], dtype=str)['images'].dropna()
+    compacted = images.map(compact_images)
+    mismatches = (compacted.map(expand_images) != images).sum()
+    fallbacks = compacted.str.count(';;<img').sum()
+    before, after = images.str.len().sum(), compacted.str.len().sum()
+    print(f"{len(images)} notes, {mismatches} differ after expanding, {fallbacks} images kept in version 1")
+    print(f"{before:,} characters -> {after:,} ({after / max(before, 1):.0%})")
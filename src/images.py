@@ -1,33 +1,24 @@
 import pandas as pd
 import os
-import requests
-from ratelimit import limits, sleep_and_retry
 import re
 from urllib.parse import quote
 from tqdm import tqdm
-
-INAT_QUERY_URL = 'https://api.inaturalist.org/v2/taxa/%s?fields=(preferred_common_name:!t,conservation_statuses:(place:!t,status:!t),extinct:!t,observations_count:!t,rank:!t,ancestors:(rank:!t,preferred_common_name:!t,name:!t),taxon_photos:(photo:(attribution:!t,license_code:!t,large_url:!t)))'
+from inat_cache import TaxonCache, DEFAULT_TTL
+from inat_client import INaturalistClient
+from instrument import step
+from image_field import image_tag, photo_urls
+
+INAT_API_URL = 'https://api.inaturalist.org'
+INAT_QUERY_PATH = '/v2/taxa/%s?fields=(preferred_common_name:!t,conservation_statuses:(place:!t,status:!t),extinct:!t,observations_count:!t,rank:!t,ancestors:(rank:!t,preferred_common_name:!t,name:!t),taxon_photos:(photo:(attribution:!t,license_code:!t,small_url:!t,medium_url:!t,large_url:!t)))'
+INAT_QUERY_URL = INAT_API_URL + INAT_QUERY_PATH
 CONSERVATION_STATUSES = {'LC': 'Least Concern', 'NT': 'Near Threatened', 'VU': 'Vulnerable', 'EN': 'Endangered', 'CR': 'Critically Endangered', 'EW': 'Extinct in the Wild', 'EX': 'Extinct', 'DD': 'Data Deficient', 'NE': 'Not Evaluated', 'CD': 'Conservation Dependent'}
 WANTED_RANKS = {'kingdom', 'class', 'order', 'family'}
-HEADERS = {'User-Agent': 'Mozilla/5.0'}
+RESULT_COLUMNS = ['inaturalistID', 'images', 'conservation_status', 'observations_count', 'preferred_common_name', 'taxonomy_tag', 'rank']
+CHUNK_ROWS = 5000 # Species processed at a time, so memory does not grow with the size of the deck
 
 def escape_characters(text):
     return text.replace(';;', quote(';;')).replace('|', quote('|')).replace('\xa0', '&nbsp;')
 
-# Maximum 30 requests per minute
-@sleep_and_retry
-@limits(calls=30, period=60)
-def fetch_inaturalist_data(ids):
-    query = INAT_QUERY_URL % ','.join(map(str, ids))
-    response = requests.get(query, headers=HEADERS, timeout=10)
-    
-    if response.status_code != 200:
-        raise Exception(f"API request failed with status code {response.status_code}: {response.text}")
-    
-    data = response.json()
-    
-    return data['results']
-
 # Generate images' HTML for Anki
 def generate_images_html(photos):
     image_html_list = []
@@ -44,7 +35,7 @@ def generate_images_html(photos):
                 print(repr(photo['photo']['attribution']), photo['photo']['license_code'])
             attribution = f'{attribution.group(1).strip('\n')}' if attribution else photo['photo']['attribution']
 
-        image_html_list.append(f'<img src="{photo["photo"]["large_url"]}">|{escape_characters(attribution)}|{escape_characters(photo["photo"]["license_code"])}')
+        image_html_list.append(f'{image_tag(photo_urls(photo["photo"]))}|{escape_characters(attribution)}|{escape_characters(photo["photo"]["license_code"])}')
 
     images_html = ';;'.join(image_html_list)
     return images_html
@@ -69,52 +60,72 @@ def get_conservation_status(conservation_statuses):
             return status['status']
     return None
 
+# Reduces one iNaturalist result to the flat fields used by the deck (None for extinct taxa)
+def reduce_result(result):
+    if result.get('extinct') == True:
+        return None
+
+    images_html = generate_images_html(result.get('taxon_photos', []))
+    taxonomy_tag = generate_taxonomy(result.get('ancestors', []))
+    conservation_status = get_conservation_status(result.get('conservation_statuses', []))
+    conservation_status = CONSERVATION_STATUSES.get(conservation_status, '')
+
+    return (result.get('id'), images_html, conservation_status, result.get('observations_count'),
+            result.get('preferred_common_name', ''), taxonomy_tag, result.get('rank', ''))
+
 def process_results_to_dataframe(results):
-    """Process iNaturalist API results into a structured dictionary for DataFrame updates."""
-    records = []
+    """Process iNaturalist API results into a DataFrame, one column at a time."""
+    columns = {column: [] for column in RESULT_COLUMNS}
     for result in results:
-        if result.get('extinct') == True:
+        record = reduce_result(result)
+        if record is None:
             continue
-        
-        images_html = generate_images_html(result.get('taxon_photos', []))
-        taxonomy_tag = generate_taxonomy(result.get('ancestors', []))
-        conservation_status = get_conservation_status(result.get('conservation_statuses', []))
-        conservation_status = CONSERVATION_STATUSES.get(conservation_status, '')
-
-        records.append({
-            'inaturalistID': result.get('id'),
-            'images': images_html,
-            'conservation_status': conservation_status,
-            'observations_count': result.get('observations_count'),
-            'preferred_common_name': result.get('preferred_common_name', ''),
-            'taxonomy_tag': taxonomy_tag,
-            'rank': result.get('rank', '')
-        })
-    results_df = pd.DataFrame(records)
+        for values, value in zip(columns.values(), record):
+            values.append(value)
+    results_df = pd.DataFrame(columns)
+    results_df['inaturalistID'] = results_df['inaturalistID'].astype(int)
+    # Int64 to allow NaNs
+    results_df['observations_count'] = pd.array(columns['observations_count'], dtype='Int64')
 
     return results_df
 
 # Gets images, conservation status, observation count, English name and taxonomy name from iNaturalist
-def get_images(deck):
+# Results are cached per taxon, so only missing or outdated taxa (older than ttl seconds) are fetched
+# api_url and the rate limit (calls per period seconds) can point the fetcher at mock_inaturalist.py
+def get_images(deck, ttl=DEFAULT_TTL, api_url=INAT_API_URL, calls=30, period=60):
     print("Getting images...")
     df = pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} species.csv'), usecols=['eolID', 'inaturalistID'], dtype={'inaturalistID': int, 'gbifID': int})
 
     # Get list of ids from iNaturalist in integer format
     ids = df['inaturalistID'].unique()
 
-    # Extract 30 ids at a time and process them in one request
-    batch_size = 30
-    all_results = []
-    with tqdm(total=len(ids), desc="Processing ids") as pbar: # Make a progress bar
-        for i in range(0, len(ids), batch_size):
-            batch_ids = ids[i:i + batch_size]
-            all_results.extend(fetch_inaturalist_data(batch_ids))
-            pbar.update(len(batch_ids))
-
-    results_df = process_results_to_dataframe(all_results)
-    # Convert observations_count to object to allow NaNs
-    results_df['observations_count'] = results_df['observations_count'].astype('Int64')
-    df_images = df.merge(results_df, on='inaturalistID', how='inner', suffixes=('', '_new'))
-    df_images.drop(columns=['inaturalistID'], inplace=True)
-
-    df_images.to_csv(os.path.join('data', 'processed', f'{deck.value['type']} species with images.csv'), index=False)
\ No newline at end of file
+    with TaxonCache(ttl=ttl) as cache:
+        missing_ids = cache.stale_ids(ids)
+        print(f"{len(ids) - len(missing_ids)} taxa cached, fetching {len(missing_ids)}")
+
+        # Fit as many ids into each request as the URL allows (the API allows 30 requests per minute)
+        with step('fetch', rows_in=len(missing_ids)) as s, \
+                INaturalistClient(api_url + INAT_QUERY_PATH, calls=calls, period=period) as client, \
+                tqdm(total=len(missing_ids), desc="Processing ids") as pbar: # Make a progress bar
+            for batch_ids in client.batches(missing_ids):
+                results, failed = client.fetch(batch_ids)
+                # Failed ids are left out of the cache and retried on the next run
+                failed = set(failed)
+                cache.store([i for i in batch_ids if i not in failed], results)
+                pbar.update(len(batch_ids))
+            print(client.stats.summary())
+            s.info.update(cache_hits=len(ids) - len(missing_ids), requests=client.stats.requests, retries=client.stats.retries, failures=client.stats.failures, throttle_seconds=round(client.stats.throttle_time, 1))
+
+        # Each chunk of species is decoded, reduced and appended to the output on its own, so only
+        # the flat records of one chunk are held in memory
+        path = os.path.join('data', 'processed', f'{deck.value['type']} species with images.csv')
+        with step('process results', rows_in=len(df)) as s, open(path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+            s.rows_out = s.info['results'] = 0
+            for start in range(0, max(len(df), 1), CHUNK_ROWS): # An empty deck still writes the header
+                df_chunk = df.iloc[start:start + CHUNK_ROWS]
+                results_df = process_results_to_dataframe(cache.load(df_chunk['inaturalistID'].unique()))
+                df_images = df_chunk.merge(results_df, on='inaturalistID', how='inner', suffixes=('', '_new'))
+                df_images.drop(columns=['inaturalistID']).to_csv(f, index=False, header=start == 0)
+                s.info['results'] += len(results_df)
+                s.rows_out += len(df_images)
+        os.replace(path + '.tmp', path)
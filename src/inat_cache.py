@@ -0,0 +1,69 @@
+import os
+import json
+import sqlite3
+import time
+
+# orjson is optional: it decodes the cached results several times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CACHE_PATH = os.path.join('data', 'cache', 'inaturalist.sqlite')
+DEFAULT_TTL = 30 * 24 * 60 * 60 # Refetch taxa older than 30 days
+
+
+def dumps(result):
+    return orjson.dumps(result).decode('utf-8') if orjson else json.dumps(result, ensure_ascii=False)
+
+def loads(text):
+    return orjson.loads(text) if orjson else json.loads(text)
+
+# Persistent cache of raw iNaturalist taxon results keyed by iNaturalist ID
+class TaxonCache:
+    def __init__(self, path=CACHE_PATH, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS taxa (id INTEGER PRIMARY KEY, fetched_at REAL NOT NULL, result TEXT)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    # Returns the ids that are not cached or older than the TTL (keeps the given order)
+    def stale_ids(self, ids):
+        cutoff = time.time() - self.ttl
+        fresh = set()
+        for chunk in _chunks(list(map(int, ids)), 900):
+            rows = self.connection.execute(f'SELECT id FROM taxa WHERE fetched_at >= ? AND id IN ({",".join("?" * len(chunk))})', [cutoff, *chunk])
+            fresh.update(row[0] for row in rows)
+        return [i for i in ids if int(i) not in fresh]
+
+    # Saves one batch in a single transaction, so an interrupted run resumes after the last batch
+    def store(self, requested_ids, results):
+        now = time.time()
+        returned = {int(result['id']): dumps(result) for result in results}
+        # Ids without a result are stored as empty so they are not refetched before the TTL runs out
+        rows = [(int(i), now, returned.pop(int(i), None)) for i in requested_ids]
+        rows.extend((i, now, result) for i, result in returned.items())
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO taxa (id, fetched_at, result) VALUES (?, ?, ?)', rows)
+
+    # Yields the cached results for the given ids, decoding one at a time
+    def load(self, ids):
+        for chunk in _chunks(list(map(int, ids)), 900):
+            rows = self.connection.execute(f'SELECT result FROM taxa WHERE result IS NOT NULL AND id IN ({",".join("?" * len(chunk))})', chunk)
+            for (result,) in rows:
+                yield loads(result)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
@@ -0,0 +1,145 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+MAX_URL_LENGTH = 8000 # Stay well below the common 8 KiB request line limit
+MAX_IDS_PER_REQUEST = 200 # Documented maximum per_page of the API, larger pages can be cut without saying so
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Spends the request budget evenly: refills `calls` tokens per `period` seconds
+class TokenBucket:
+    def __init__(self, calls, period, capacity=1):
+        self.rate = calls / period
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Blocks until a token is available and returns the time spent waiting
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    # Empties the bucket for a while, e.g. when the server asks to slow down
+    def pause(self, seconds):
+        with self.lock:
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class RunStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.throttle_time = 0.0
+        self.ids = 0
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        ids_per_second = self.ids / elapsed if elapsed else 0.0
+        return (f"{self.requests} requests, {self.retries} retries, {self.failures} failed, "
+                f"{self.throttle_time:.0f}s throttled, {self.ids} ids in {elapsed:.0f}s ({ids_per_second:.1f} ids/s)")
+
+
+# iNaturalist API client with a pooled session, rate limiting and retries
+class INaturalistClient:
+    def __init__(self, query_url, calls=30, period=60, max_retries=5, backoff=2.0, timeout=30, session=None):
+        self.query_url = query_url
+        self.bucket = TokenBucket(calls, period)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.stats = RunStats()
+        self.session = session or requests.Session()
+        self.session.headers.update(HEADERS)
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.session.close()
+
+    # Packs as many ids into each request as the URL length allows
+    def batches(self, ids):
+        base_length = len(self.query_url % '')
+        batch, length = [], base_length
+        for i in map(str, ids):
+            extra = len(i) + (1 if batch else 0)
+            if batch and (length + extra > MAX_URL_LENGTH or len(batch) >= MAX_IDS_PER_REQUEST):
+                yield batch
+                batch, length = [], base_length
+                extra = len(i)
+            batch.append(i)
+            length += extra
+        if batch:
+            yield batch
+
+    # Returns the results for the ids and the ids whose request kept failing
+    def fetch(self, ids):
+        query = self.query_url % ','.join(map(str, ids)) + f'&per_page={len(ids)}'
+        for attempt in range(self.max_retries + 1):
+            self.stats.throttle_time += self.bucket.acquire()
+            self.stats.requests += 1
+            try:
+                response = self.session.get(query, timeout=self.timeout)
+            except requests.RequestException as error:
+                response, reason = None, str(error)
+            else:
+                try:
+                    data = response.json() if response.status_code == 200 else None
+                except ValueError:
+                    # An error page sent with status 200 is retried like a server error
+                    data = None
+                if isinstance(data, dict) and 'results' in data:
+                    # Split the batch if the server returned fewer results than it found or used a smaller page,
+                    # so the ids left out are not cached as taxa without a result
+                    truncated = data.get('total_results', 0) > len(data['results']) or data.get('per_page', len(ids)) < len(ids)
+                    if truncated and len(ids) > 1:
+                        middle = len(ids) // 2
+                        (first, first_failed), (second, second_failed) = self.fetch(ids[:middle]), self.fetch(ids[middle:])
+                        return first + second, first_failed + second_failed
+                    self.stats.ids += len(ids)
+                    return data['results'], []
+                reason = f"status code {response.status_code}: {response.text[:200]}"
+                if response.status_code != 200 and response.status_code not in RETRY_STATUSES:
+                    break
+
+            if attempt == self.max_retries:
+                break
+            self.stats.retries += 1
+            # The next acquire() waits out the delay
+            delay = self._retry_after(response) or self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            self.bucket.pause(delay)
+
+        self.stats.failures += 1
+        print(f"API request failed with {reason}")
+        return [], list(ids)
+
+    # Seconds to wait from the Retry-After header (either seconds or an HTTP date)
+    @staticmethod
+    def _retry_after(response):
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
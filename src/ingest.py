@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from instrument import step
+
+# Parquet is optional: without pyarrow every read falls back to the source file
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+INPUT_DIR = os.path.join('data', 'input')
+CACHE_DIR = os.path.join('data', 'cache', 'columnar')
+CHUNK_SIZE = 1_000_000
+
+MEDIA_RESOURCE = {'sep': '\t', 'dtype': {'taxonID': str, 'CVterm': 'category', 'description': str, 'furtherInformationURL': str}}
+# Full and delta GBIF exports, with the range of occurrence ids counted in each row.
+# Exports made with an earlier query.json do not have the ids.
+GBIF_OUTPUT = {'sep': '\t', 'dtype': {'taxonkey': 'Int64', 'countrycode': 'category', 'observation_count': 'Int64', 'min_gbifid': 'Int64', 'max_gbifid': 'Int64'}, 'optional': {'min_gbifid', 'max_gbifid'}, 'keep_default_na': False, 'na_values': ['']}
+
+# Columns kept from each input file with their types. Ids are integers and
+# repeated values are stored as categories.
+INPUTS = {
+    'taxon.tab': {'sep': '\t', 'dtype': {'eolID': 'Int64', 'canonicalName': str, 'higherClassification': str, 'taxonRank': 'category'}},
+    'full_provider_ids.csv': {'sep': ',', 'dtype': {'resource_pk': str, 'resource_id': 'int32', 'page_id': 'Int64'}},
+    'vernacularnames.csv': {'sep': ',', 'dtype': {'page_id': 'Int64', 'vernacular_string': str, 'language_code': 'category', 'is_preferred_by_resource': 'category', 'is_preferred_by_eol': 'category'}},
+    'GBIF_output.csv': GBIF_OUTPUT,
+    'GBIF_output.zip': GBIF_OUTPUT,
+    'GBIF_delta.csv': GBIF_OUTPUT,
+    'GBIF_delta.zip': GBIF_OUTPUT,
+    os.path.join('arkive', 'media_resource.tab'): {'sep': '\t', 'dtype': {'taxonID': str, 'title': 'category', 'description': str}},
+    os.path.join('animal_diversity_web', 'media_resource.tab'): MEDIA_RESOURCE,
+    os.path.join('fishbase', 'media_resource.tab'): MEDIA_RESOURCE,
+    os.path.join('wikipedia', 'media_resource.tab'): MEDIA_RESOURCE,
+    os.path.join('amphibia_web', 'media_resource.tab'): MEDIA_RESOURCE,
+}
+
+ARROW_TYPES = {'Int64': 'int64', 'int32': 'int32', 'category': 'string', str: 'string'}
+
+
+def _read_csv(name, columns, **kwargs):
+    spec = INPUTS[name]
+    dtype = {column: spec['dtype'][column] for column in columns}
+    options = {key: value for key, value in spec.items() if key not in ('dtype', 'optional')}
+    return pd.read_csv(os.path.join(INPUT_DIR, name), usecols=columns, dtype=dtype, **options, **kwargs)
+
+# Columns of the spec that the file has, optional columns of the spec may be missing
+def input_columns(name):
+    spec = INPUTS[name]
+    if not spec.get('optional'):
+        return list(spec['dtype'])
+    header = pd.read_csv(os.path.join(INPUT_DIR, name), sep=spec['sep'], nrows=0).columns
+    return [column for column in spec['dtype'] if column not in spec['optional'] or column in header]
+
+def _cache_path(name):
+    return os.path.join(CACHE_DIR, name.replace(os.sep, '__') + '.parquet')
+
+# Identifies the source file version and the column spec the cache was built from
+def _signature(name):
+    stat = os.stat(os.path.join(INPUT_DIR, name))
+    spec = json.dumps({column: str(dtype) for column, dtype in INPUTS[name]['dtype'].items()})
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'spec': hashlib.sha256(spec.encode()).hexdigest()}
+
+# Converts the source file to Parquet once, and again whenever it changes
+def ensure_cache(name):
+    path = _cache_path(name)
+    signature = _signature(name)
+    if os.path.exists(path) and os.path.exists(path + '.json'):
+        with open(path + '.json', encoding='utf-8') as f:
+            if json.load(f) == signature:
+                return path
+
+    print(f"Caching {name}...")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    columns = input_columns(name)
+    schema = pa.schema([(column, getattr(pa, ARROW_TYPES[INPUTS[name]['dtype'][column]])()) for column in columns])
+    # Each chunk becomes a row group, so readers can skip groups by their statistics
+    with step(f'cache {name}') as s, pq.ParquetWriter(path + '.tmp', schema, compression='zstd') as writer:
+        s.rows_out = 0
+        for chunk in _read_csv(name, columns, chunksize=CHUNK_SIZE):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            s.rows_out += len(chunk)
+    os.replace(path + '.tmp', path)
+    with open(path + '.json', 'w', encoding='utf-8') as f:
+        json.dump(signature, f)
+    return path
+
+def _to_pandas(table, name):
+    df = table.to_pandas()
+    for column in df.columns:
+        dtype = INPUTS[name]['dtype'][column]
+        if dtype == 'Int64':
+            df[column] = df[column].astype('Int64')
+        elif dtype == 'category' and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
+
+
+# Reads the columns of an input file, optionally only rows where column == value (or in a list of values)
+def read_input(name, columns, where=None):
+    if pq is None:
+        df = _read_csv(name, columns)
+        for column, value in (where or {}).items():
+            df = df[df[column].isin(value if isinstance(value, list) else [value])]
+        return df
+
+    filters = [(column, 'in' if isinstance(value, list) else '==', value) for column, value in (where or {}).items()] or None
+    categories = [column for column in columns if INPUTS[name]['dtype'][column] == 'category']
+    table = pq.read_table(ensure_cache(name), columns=columns, filters=filters, memory_map=True, read_dictionary=categories)
+    return _to_pandas(table, name)
+
+# Yields the columns of an input file in chunks of rows
+def iter_input(name, columns, chunksize=CHUNK_SIZE):
+    if pq is None:
+        yield from _read_csv(name, columns, chunksize=chunksize)
+        return
+
+    categories = [column for column in columns if INPUTS[name]['dtype'][column] == 'category']
+    parquet_file = pq.ParquetFile(ensure_cache(name), memory_map=True, read_dictionary=categories)
+    for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+        yield _to_pandas(pa.Table.from_batches([batch]), name)
@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import html
+import signal
+import shutil
+import cProfile
+import subprocess
+from contextlib import contextmanager
+
+# resource is only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPORT_DIR = os.path.join('data', 'reports')
+# Set to 'cprofile' to save a .prof file per stage, or 'py-spy' to record a flame graph with py-spy
+PROFILE_VARIABLE = 'PIPELINE_PROFILE'
+# Set by the pipeline to the name of the run, shared by the processes of its stages
+RUN_VARIABLE = 'PIPELINE_RUN'
+MIB = 1024 * 1024
+
+_open = []  # Steps currently running, outermost first
+_steps = []  # Steps of the current stage in the order they started
+
+
+# Resident memory of this process in bytes (None where it cannot be read)
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# Highest resident memory since the last reset_peak(), or since the process started where it cannot be reset
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+# The peak since the last reset belongs to every step that is still open
+def _update_peaks():
+    peak = peak_rss()
+    if peak is not None:
+        for open_step in _open:
+            open_step.peak = max(open_step.peak or 0, peak)
+
+
+class Step:
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.depth = len(_open)
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.info = {}
+        self.seconds = None
+        self.rss_before = current_rss()
+        self.rss_after = None
+        self.peak = self.rss_before
+
+    def as_dict(self):
+        dropped = self.rows_in - self.rows_out if self.rows_in is not None and self.rows_out is not None else None
+        delta = self.rss_after - self.rss_before if self.rss_after is not None and self.rss_before is not None else None
+        return {
+            'step': self.name,
+            'depth': self.depth,
+            'seconds': round(self.seconds, 3) if self.seconds is not None else None,
+            'peak_rss_mb': round(self.peak / MIB, 1) if self.peak else None,
+            'delta_rss_mb': round(delta / MIB, 1) if delta is not None else None,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'dropped': dropped,
+            **self.info,
+        }
+
+# Measures a block of a stage. Set .rows_out on the yielded step, and add other numbers
+# (e.g. cache hits) to .info:
+#     with step('merge inaturalistID', rows_in=len(df)) as s:
+#         df = df.merge(...)
+#         s.rows_out = len(df)
+@contextmanager
+def step(name, rows_in=None):
+    _update_peaks()
+    reset_peak()
+    current = Step(name, rows_in)
+    _open.append(current)
+    _steps.append(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - start
+        _update_peaks()
+        _open.pop()
+        current.rss_after = current_rss()
+
+
+@contextmanager
+def profiler(name, directory):
+    mode = os.environ.get(PROFILE_VARIABLE, '').lower()
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(os.path.join(directory, f'{name}.prof'))
+    elif mode == 'py-spy' and shutil.which('py-spy'):
+        # py-spy samples this process from outside and writes the flame graph when interrupted
+        spy = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--output', os.path.join(directory, f'{name}.svg')])
+        try:
+            yield
+        finally:
+            spy.send_signal(signal.SIGINT)
+            spy.wait()
+    else:
+        yield
+
+# Measures a whole stage with its steps and saves them as <name>.json in directory
+@contextmanager
+def stage_report(name, directory):
+    os.makedirs(directory, exist_ok=True)
+    _steps.clear()
+    started = time.time()
+    status = 'failed'
+    try:
+        with profiler(name, directory), step(name):
+            yield
+        status = 'ok'
+    finally:
+        with open(os.path.join(directory, f'{name}.json'), 'w', encoding='utf-8') as f:
+            json.dump({'stage': name, 'status': status, 'started': started, 'steps': [s.as_dict() for s in _steps]}, f, indent=1)
+
+
+COLUMNS = ['seconds', 'peak_rss_mb', 'delta_rss_mb', 'rows_in', 'rows_out', 'dropped']
+
+def _html_report(report):
+    rows = []
+    for stage in report['stages']:
+        for s in stage['steps']:
+            info = ', '.join(f'{key}: {value}' for key, value in s.items() if key not in COLUMNS + ['step', 'depth'])
+            cells = ''.join(f'<td>{"" if s[column] is None else s[column]}</td>' for column in COLUMNS)
+            style = ' style="font-weight:bold"' if s['depth'] == 0 else ''
+            rows.append(f'<tr{style}><td style="padding-left:{s["depth"] * 20 + 4}px">{html.escape(s["step"])}</td>{cells}<td>{html.escape(info)}</td></tr>')
+    skipped = ''.join(f'<li>{html.escape(name)}</li>' for name in report['up_to_date'])
+    header = ''.join(f'<th>{column}</th>' for column in ['step'] + COLUMNS + ['info'])
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>Run {report["run"]}</title>'
+            '<style>table{border-collapse:collapse;font-family:sans-serif;font-size:14px}td,th{border:1px solid #ccc;padding:2px 6px;text-align:right}td:first-child,td:last-child{text-align:left}</style></head>'
+            f'<body><h1>Run {report["run"]}</h1><table><tr>{header}</tr>{"".join(rows)}</table><h2>Up to date</h2><ul>{skipped}</ul></body></html>')
+
+# Combines the stage files of a run into report.json and report.html
+def write_report(directory, up_to_date=()):
+    stages = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json') and name != 'report.json':
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                stages.append(json.load(f))
+    stages.sort(key=lambda stage: stage['started'])
+    report = {'run': os.path.basename(directory), 'stages': stages, 'up_to_date': list(up_to_date)}
+    with open(os.path.join(directory, 'report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    with open(os.path.join(directory, 'report.html'), 'w', encoding='utf-8') as f:
+        f.write(_html_report(report))
+    return report
@@ -1,21 +1,86 @@
+import sys
+import argparse
 from taxa import Deck
-from species import get_taxa
-from identification import get_identification
-from translations import get_translations
-from images import get_images
-from countries import get_countries
-from combine_data import combine_data
+from pipeline import STAGES, run_pipeline, run_single_stage
 
-WANTED_DECK = Deck.ANIMALS
+# Decks built when --deck is not given
+WANTED_DECKS = [Deck.ANIMALS]
 
-def main():
-    # get_taxa(WANTED_DECK)
-    get_identification(WANTED_DECK)
-    # get_translations(WANTED_DECK)
-    # get_countries(WANTED_DECK)
-    # get_images(WANTED_DECK)
-    combine_data(WANTED_DECK)
+# Shared inputs are read once for all wanted decks.
+# Stages are only rerun when their input files or code changed.
+# Add stage names to FORCE (or use --force) to rerun them anyway, e.g. {'images'}.
+FORCE = set()
+
+# Only the taxa and pipeline modules are imported at startup, each stage or tool imports
+# pandas and its other dependencies when it runs, so --help and argument errors are instant.
+
+
+def parse_decks(names):
+    if 'ALL' in names:
+        return list(Deck)
+    return [Deck[name] for name in dict.fromkeys(names)]
+
+def build(args):
+    run_pipeline(args.deck, force=FORCE | set(args.force), max_workers=args.workers)
+
+def run_stage(args):
+    run_single_stage(args.command, args.deck)
+
+def release(args):
+    from release import create_release
+    for deck in args.deck:
+        create_release(deck, delta=not args.full)
+
+def subdecks(args):
+    from subdecks import create_subdecks
+    for deck in args.deck:
+        create_subdecks(deck, args.kinds, args.workers)
+
+def sort(args):
+    from sort import sort_decks
+    sort_decks(args.deck, args.column)
+
+
+def make_parser():
+    decks = argparse.ArgumentParser(add_help=False)
+    decks.add_argument('--deck', nargs='+', type=str.upper, choices=[deck.name for deck in Deck] + ['ALL'], default=[deck.name for deck in WANTED_DECKS],
+                       help=f"decks to work on, or all (default: {' '.join(deck.name for deck in WANTED_DECKS)})")
+
+    parser = argparse.ArgumentParser(description='Build the Anki species decks. Without a command, runs the stages that are out of date.')
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+
+    command = commands.add_parser('build', parents=[decks], help='run the stages that are out of date')
+    command.add_argument('--force', nargs='+', default=[], choices=[stage.name for stage in STAGES], help='stages to rerun anyway')
+    command.add_argument('--workers', type=int, default=None, help='parallel stages (default: number of CPUs)')
+    command.set_defaults(handler=build)
+
+    for stage in STAGES:
+        command = commands.add_parser(stage.name, parents=[decks], help=f'run only the {stage.name} stage ({stage.module}.{stage.function}), even if it is up to date')
+        command.set_defaults(handler=run_stage)
+
+    command = commands.add_parser('release', parents=[decks], help='write the notes changed since the last release')
+    command.add_argument('--full', action='store_true', help='record a release without writing a delta')
+    command.set_defaults(handler=release)
+
+    command = commands.add_parser('subdecks', parents=[decks], help='write a deck per country, class and order')
+    command.add_argument('--kinds', nargs='+', default=['countries', 'clades'], choices=['countries', 'clades'])
+    command.add_argument('--workers', type=int, default=None, help='parallel processes writing the decks')
+    command.set_defaults(handler=subdecks)
+
+    command = commands.add_parser('sort', parents=[decks], help='sort the rows of exported decks (data/output/<deck>.txt)')
+    command.add_argument('--column', type=int, default=None, help='number of the column to sort by, counting from 1, for exports without a #columns line')
+    command.set_defaults(handler=sort)
+    return parser
+
+# Usage: python src/main.py [command] [--deck DECK ... | all], e.g. python src/main.py images --deck BIRDS MAMMALS
+def main(argv):
+    # Without a command the pipeline is built, e.g. python src/main.py --deck all
+    if not argv or argv[0].startswith('-') and argv[0] not in ('-h', '--help'):
+        argv = ['build'] + argv
+    args = make_parser().parse_args(argv)
+    args.deck = parse_decks(args.deck)
+    args.handler(args)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(sys.argv[1:])
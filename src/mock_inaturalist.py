@@ -0,0 +1,158 @@
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter, deque
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from synthetic import seeded_inaturalist_result
+
+TAXA_PATH = re.compile(r'/v2/taxa/(\d+(?:,\d+)*)')
+PHOTO_PATH = re.compile(r'/photos/(\d+)/\w+\.\w+')
+DEFAULT_PER_PAGE = 30 # Page size of the API when per_page is not given
+ERROR_STATUSES = [429, 500, 502, 503, 504]
+
+
+# Local stand-in for the iNaturalist taxa endpoint used by INAT_QUERY_URL, for benchmarks without network access.
+# Results are synthetic and depend only on the seed and taxon id. The server can add latency, limit the
+# request rate like the API (429 with Retry-After) and fail a share of the requests with 429 or 5xx.
+# It also answers HEAD requests for photos (/photos/<id>/<size>.jpg), with a share of them deleted (404).
+class MockINaturalistServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, calls=None, period=60, error_rate=0.0, missing_rate=0.0, photo_missing_rate=0.0, seed=0):
+        super().__init__(address, MockINaturalistHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = calls
+        self.period = period
+        self.error_rate = error_rate
+        self.missing_rate = missing_rate
+        self.photo_missing_rate = photo_missing_rate
+        self.seed = seed
+        self.rng = random.Random(f'{seed}-mock')
+        self.lock = threading.Lock()
+        self.admitted = deque() # Times of the requests in the current rate limit window
+        self.statuses = Counter()
+        self.ids = 0
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    # Returns an error status (and the seconds to retry after) for rate limited or failed requests, or None
+    def admit(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.calls:
+                while self.admitted and self.admitted[0] <= now - self.period:
+                    self.admitted.popleft()
+                if len(self.admitted) >= self.calls:
+                    return 429, self.admitted[0] + self.period - now
+                self.admitted.append(now)
+            if self.rng.random() < self.error_rate:
+                return self.rng.choice(ERROR_STATUSES), 1
+            return None, None
+
+    def delay(self):
+        with self.lock:
+            return max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+    # Taxa missing from the API are chosen by id, so they are the same in every request
+    def result(self, taxon_id):
+        if self.missing_rate and random.Random(f'{self.seed}-missing-{taxon_id}').random() < self.missing_rate:
+            return None
+        return seeded_inaturalist_result(taxon_id, self.seed)
+
+    def photo_exists(self, photo_id):
+        return not (self.photo_missing_rate and random.Random(f'{self.seed}-photo-{photo_id}').random() < self.photo_missing_rate)
+
+    def record(self, status, ids=0):
+        with self.lock:
+            self.statuses[status] += 1
+            self.ids += ids
+
+    def stats(self):
+        with self.lock:
+            return {'requests': sum(self.statuses.values()), 'ids': self.ids, 'statuses': {str(status): count for status, count in sorted(self.statuses.items())}}
+
+    # Serves in a background thread until the with block ends
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class MockINaturalistHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keeps connections open, so the clients' connection pools are used
+    def do_GET(self):
+        url = urlsplit(self.path)
+        match = TAXA_PATH.fullmatch(url.path)
+        if not match:
+            return self.reply(404, {'error': 'Not found', 'status': 404})
+
+        status, retry_after = self.server.admit()
+        time.sleep(self.server.delay())
+        if status:
+            return self.reply(status, {'error': 'Too Many Requests' if status == 429 else 'Server Error', 'status': status},
+                              {'Retry-After': str(max(1, round(retry_after)))} if status == 429 else {})
+
+        per_page = int(parse_qs(url.query).get('per_page', [DEFAULT_PER_PAGE])[0])
+        results = [result for result in map(self.server.result, map(int, match.group(1).split(','))) if result is not None]
+        # Like the API, total_results counts every match even when they do not fit on the page
+        self.reply(200, {'total_results': len(results), 'page': 1, 'per_page': per_page, 'results': results[:per_page]}, ids=min(per_page, len(results)))
+
+    # Photos are not rate limited, like the image bucket of the real site
+    def do_HEAD(self):
+        match = PHOTO_PATH.fullmatch(urlsplit(self.path).path)
+        time.sleep(self.server.delay())
+        status = 200 if match and self.server.photo_exists(int(match.group(1))) else 404
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/jpeg' if status == 200 else 'application/xml')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.server.record(status)
+
+    def reply(self, status, body, headers=None, ids=0):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.record(status, ids)
+
+    def log_message(self, *args):
+        pass
+
+
+# Usage: python src/mock_inaturalist.py --port 8000 --latency 0.2 --calls 60 --error-rate 0.05
+# and point get_images(deck, api_url='http://127.0.0.1:8000') at it
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic iNaturalist taxa locally.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random seconds added to or taken from the latency')
+    parser.add_argument('--calls', type=int, default=None, help='requests allowed per period, more are answered with 429')
+    parser.add_argument('--period', type=float, default=60)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 429 or 5xx')
+    parser.add_argument('--missing-rate', type=float, default=0.0, help='share of taxa the API does not know')
+    parser.add_argument('--photo-missing-rate', type=float, default=0.0, help='share of photos that are deleted')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockINaturalistServer(('127.0.0.1', args.port), args.latency, args.jitter, args.calls, args.period, args.error_rate, args.missing_rate, args.photo_missing_rate, args.seed)
+    print(f"Serving synthetic iNaturalist taxa on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats()))
+        sys.exit(0)
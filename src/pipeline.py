@@ -0,0 +1,224 @@
+import os
+import json
+import hashlib
+import importlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from taxa import deck_list
+from instrument import REPORT_DIR, RUN_VARIABLE, stage_report, write_report
+
+STATE_PATH = os.path.join('data', 'pipeline_state.json')
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Each stage declares the files it reads, the file it writes and the code it depends on.
+# '{type}' is replaced with the deck type, e.g. 'Animal'.
+# Multi-deck stages are called once with all decks that need them, so shared inputs are read once.
+# On demand stages are left out of builds unless forced, e.g. python src/main.py --force validate.
+class Stage:
+    def __init__(self, name, module, function, inputs, output, code, after=(), multi_deck=False, optional=(), on_demand=False):
+        self.name = name
+        self.module = module
+        self.function = function
+        self.inputs = inputs
+        self.optional = list(optional)
+        self.on_demand = on_demand
+        self.output = output
+        self.code = code
+        self.after = after
+        self.multi_deck = multi_deck
+
+    # A tuple of inputs means the first of them that exists. Optional inputs are read when they exist,
+    # and are left out with required_only
+    def paths(self, deck, required_only=False):
+        options = self.inputs if required_only else self.inputs + self.optional
+        inputs = [next((path for path in option if os.path.exists(path)), option[0]) if isinstance(option, tuple) else option for option in options]
+        inputs = [path.format(type=deck.value['type']) for path in inputs]
+        return inputs, self.output.format(type=deck.value['type'])
+
+
+def processed(name):
+    return os.path.join('data', 'processed', f'{{type}} {name}')
+
+def raw(*name):
+    return os.path.join('data', 'input', *name)
+
+STAGES = [
+    Stage('taxa', 'species', 'get_taxa',
+          inputs=[raw('taxon.tab'), raw('full_provider_ids.csv')],
+          output=processed('species.csv'), code=['species.py', 'taxonomy_index.py', 'provider_index.py', 'taxa.py', 'ingest.py'], multi_deck=True),
+    Stage('identification', 'identification', 'get_identification',
+          inputs=[processed('species.csv')] + [raw(resource, 'media_resource.tab') for resource in ['arkive', 'animal_diversity_web', 'fishbase', 'wikipedia', 'amphibia_web']],
+          output=processed('species with identification.csv'), code=['identification.py', 'description_cache.py', 'ingest.py'], after=['taxa']),
+    Stage('translations', 'translations', 'get_translations',
+          inputs=[processed('species.csv'), raw('vernacularnames.csv')],
+          output=processed('species with translations.csv'), code=['translations.py', 'fields.py', 'ingest.py'], after=['taxa'], multi_deck=True),
+    Stage('countries', 'countries', 'get_countries',
+          inputs=[processed('species.csv'), (raw('GBIF_output.csv'), raw('GBIF_output.zip'))],
+          output=processed('species with countries.csv'), code=['countries.py', 'gbif_counts.py', 'ingest.py'], after=['taxa'], multi_deck=True,
+          optional=[(raw('GBIF_delta.csv'), raw('GBIF_delta.zip'))]),
+    Stage('images', 'images', 'get_images',
+          inputs=[processed('species.csv')],
+          output=processed('species with images.csv'), code=['images.py', 'image_field.py', 'inat_client.py', 'inat_cache.py'], after=['taxa']),
+    Stage('validate', 'validate_images', 'validate_images',
+          inputs=[processed('species.csv'), processed('species with images.csv')],
+          output=processed('bad images.csv'), code=['validate_images.py', 'combine_data.py'], after=['images'], on_demand=True),
+    Stage('combine', 'combine_data', 'combine_data',
+          inputs=[processed(name) for name in ['species.csv', 'species with identification.csv', 'species with translations.csv', 'species with countries.csv', 'species with images.csv']],
+          output=os.path.join('data', 'output', 'The {type} Deck.csv'), code=['combine_data.py', 'fields.py', 'image_field.py', 'taxa.py'],
+          after=['identification', 'translations', 'countries', 'validate'], optional=[processed('bad images.csv')]),
+    Stage('package', 'apkg', 'create_apkg',
+          inputs=[os.path.join('data', 'output', 'The {type} Deck.csv')] + [os.path.join('card-templates', name) for name in ['front.html', 'back.html', 'style.css']],
+          output=os.path.join('data', 'output', 'The {type} Deck.apkg'), code=['apkg.py', 'fields.py'], after=['combine']),
+]
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Content hashes of files, only recomputed when size or mtime changed since the last run
+class FileHashes:
+    def __init__(self, known):
+        self.known = known
+
+    def get(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        entry = self.known.get(path)
+        if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': hash_file(path)}
+            self.known[path] = entry
+        return entry['sha256']
+
+
+def load_state():
+    if not os.path.exists(STATE_PATH):
+        return {'files': {}, 'stages': {}}
+    with open(STATE_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_state(state):
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    with open(STATE_PATH + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=1)
+    os.replace(STATE_PATH + '.tmp', STATE_PATH)
+
+
+def fingerprint(stage, deck, hashes):
+    inputs, _ = stage.paths(deck)
+    return {
+        'inputs': {path: hashes.get(path) for path in inputs},
+        'code': {name: hashes.get(os.path.join(SRC_DIR, name)) for name in stage.code},
+    }
+
+# Returns why the stage has to run, or None if its output is up to date
+def needs_run(stage, deck, state, hashes):
+    inputs, output = stage.paths(deck)
+    if not os.path.exists(output):
+        missing = [path for path in stage.paths(deck, required_only=True)[0] if not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError(f"Cannot build {output}, missing {', '.join(missing)}")
+        return 'no output'
+
+    current = fingerprint(stage, deck, hashes)
+    recorded = state['stages'].get(f"{deck.name}:{stage.name}")
+    if recorded is None:
+        # First run with the pipeline: trust outputs that are newer than their inputs
+        output_mtime = os.path.getmtime(output)
+        if any(os.path.exists(path) and os.path.getmtime(path) > output_mtime for path in inputs):
+            return 'inputs newer than output'
+        state['stages'][f"{deck.name}:{stage.name}"] = current
+        return None
+
+    # Raw inputs that are not downloaded cannot invalidate an existing output
+    changed = [path for path, digest in current['inputs'].items() if digest is not None and digest != recorded['inputs'].get(path)]
+    if changed:
+        return f"changed {', '.join(os.path.basename(path) for path in changed)}"
+    if current['code'] != recorded['code']:
+        return 'code changed'
+    return None
+
+
+# Runs a stage function and saves its measurements in the run's report directory
+def run_stage(module, function, deck, report_dir, name):
+    with stage_report(name, report_dir):
+        getattr(importlib.import_module(module), function)(deck)
+
+
+# Runs one stage for the decks in this process, whether or not it is up to date
+def run_single_stage(name, decks):
+    stage = next(stage for stage in STAGES if stage.name == name)
+    decks = deck_list(decks)
+    state = load_state()
+    hashes = FileHashes(state['files'])
+    report_dir = os.path.join(REPORT_DIR, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    os.environ[RUN_VARIABLE] = os.path.basename(report_dir)
+    try:
+        for group in [decks] if stage.multi_deck else [[deck] for deck in decks]:
+            run_stage(stage.module, stage.function, group if stage.multi_deck else group[0], report_dir, f"{'+'.join(deck.name for deck in group)} {stage.name}")
+            for deck in group:
+                state['stages'][f"{deck.name}:{name}"] = fingerprint(stage, deck, hashes)
+    finally:
+        save_state(state)
+        if os.path.exists(report_dir):
+            write_report(report_dir)
+            print(f"Run report: {os.path.join(report_dir, 'report.html')}")
+
+# Runs the stages of one or more decks that are out of date, independent stages in parallel processes
+def run_pipeline(decks, force=(), max_workers=None):
+    decks = deck_list(decks)
+    state = load_state()
+    hashes = FileHashes(state['files'])
+    done, running = set(), {}
+    report_dir = os.path.join(REPORT_DIR, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    os.environ[RUN_VARIABLE] = os.path.basename(report_dir)
+    up_to_date = []
+
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while len(done) < len(STAGES) * len(decks):
+                for stage in STAGES:
+                    ready = []
+                    for deck in decks:
+                        if (deck, stage.name) in done or any((deck, stage.name) in jobs for jobs in running.values()) or not all((deck, name) in done for name in stage.after):
+                            continue
+                        if stage.on_demand and stage.name not in force:
+                            done.add((deck, stage.name))
+                            continue
+                        reason = 'forced' if stage.name in force else needs_run(stage, deck, state, hashes)
+                        if reason is None:
+                            print(f"{deck.value['type']} {stage.name}: up to date")
+                            up_to_date.append(f"{deck.name} {stage.name}")
+                            done.add((deck, stage.name))
+                            continue
+                        print(f"{deck.value['type']} {stage.name}: running ({reason})")
+                        ready.append(deck)
+
+                    groups = [ready] if stage.multi_deck and ready else [[deck] for deck in ready]
+                    for group in groups:
+                        name = f"{'+'.join(deck.name for deck in group)} {stage.name}"
+                        future = executor.submit(run_stage, stage.module, stage.function, group if stage.multi_deck else group[0], report_dir, name)
+                        running[future] = [(deck, stage.name) for deck in group]
+
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    jobs = running.pop(future)
+                    future.result()
+                    for deck, name in jobs:
+                        stage = next(stage for stage in STAGES if stage.name == name)
+                        state['stages'][f"{deck.name}:{name}"] = fingerprint(stage, deck, hashes)
+                        done.add((deck, name))
+                    save_state(state)
+    finally:
+        save_state(state)
+        # Failed stages are in the report too, with the steps they finished
+        if os.path.exists(report_dir):
+            write_report(report_dir, up_to_date)
+            print(f"Run report: {os.path.join(report_dir, 'report.html')}")
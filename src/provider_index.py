@@ -0,0 +1,74 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from ingest import INPUT_DIR, iter_input
+from instrument import step
+
+INDEX_PATH = os.path.join('data', 'cache', 'provider_ids.npz')
+# ID column of each resource in the species file, in column order
+PROVIDER_COLUMNS = {1177: 'inaturalistID', 1178: 'gbifID', 617: 'wikipediaID', 775: 'arkiveID', 560: 'adwID', 395: 'fishbaseID', 564: 'amphibiawebID'}
+
+
+# The keys of the wanted resources for every EOL page, built once from full_provider_ids.csv.
+# Pages are a sorted array and each resource has a byte string array aligned to it (b'' if the page has no key).
+class ProviderIndex:
+    def __init__(self, pages, keys):
+        self.pages = pages
+        self.keys = keys
+
+    @staticmethod
+    def _signature():
+        stat = os.stat(os.path.join(INPUT_DIR, 'full_provider_ids.csv'))
+        return json.dumps({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'resources': list(PROVIDER_COLUMNS)})
+
+    # Loads the saved index, or builds it when the input file changed since it was saved
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        signature = cls._signature()
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                if str(saved['signature']) == signature:
+                    return cls(saved['pages'], {resource_id: saved[str(resource_id)] for resource_id in PROVIDER_COLUMNS})
+
+        index = cls.build()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, signature=signature, pages=index.pages, **{str(resource_id): keys for resource_id, keys in index.keys.items()})
+        os.replace(path + '.tmp', path)
+        return index
+
+    @classmethod
+    def build(cls):
+        with step('build provider index') as s:
+            df = pd.concat(
+                chunk[chunk['resource_id'].isin(PROVIDER_COLUMNS.keys())].dropna(subset=['page_id', 'resource_pk'])
+                for chunk in iter_input('full_provider_ids.csv', ['resource_pk', 'resource_id', 'page_id'])
+            )
+            s.rows_in = len(df)
+            # The last key listed for a page is the one used
+            df = df.drop_duplicates(subset=['resource_id', 'page_id'], keep='last')
+            pages = np.unique(df['page_id'].to_numpy(dtype='int64'))
+
+            keys = {}
+            for resource_id in PROVIDER_COLUMNS:
+                df_resource = df[df['resource_id'] == resource_id]
+                positions = np.searchsorted(pages, df_resource['page_id'].to_numpy(dtype='int64'))
+                encoded = df_resource['resource_pk'].str.encode('utf-8').to_numpy()
+                keys[resource_id] = np.zeros(len(pages), dtype=f'S{max(map(len, encoded), default=1)}')
+                keys[resource_id][positions] = encoded
+            s.rows_out = len(pages)
+        return cls(pages, keys)
+
+    # Returns the ID columns for the given EOL page ids (NaN where a page has no key) in one lookup
+    def lookup(self, page_ids):
+        page_ids = pd.Series(page_ids).to_numpy(dtype='int64', na_value=-1)
+        positions = np.searchsorted(self.pages, page_ids).clip(max=len(self.pages) - 1)
+        found = self.pages[positions] == page_ids if len(self.pages) else np.zeros(len(page_ids), dtype=bool)
+
+        columns = {}
+        for resource_id, column in PROVIDER_COLUMNS.items():
+            keys = np.where(found, self.keys[resource_id][positions] if len(self.pages) else b'', b'')
+            values = pd.Series(np.char.decode(keys, 'utf-8'), dtype=object)
+            columns[column] = values.where(keys != b'')
+        return pd.DataFrame(columns)
@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import shutil
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from combine_data import COLUMNS, create_csv
+from apkg import read_deck_csv, write_apkg, note_guid
+
+RELEASE_DIR = os.path.join('data', 'releases')
+
+
+def deck_dir(species_type):
+    return os.path.join(RELEASE_DIR, f'The {species_type} Deck')
+
+# A 64-bit hash of every field of every note, one row per note and one column per field in COLUMNS
+def note_hashes(df):
+    return np.column_stack([pd.util.hash_array(df[column].to_numpy(dtype=object)) for column in COLUMNS])
+
+# The EOL IDs and field hashes of the notes in the last release, or None before the first release
+def load_manifest(species_type):
+    path = os.path.join(deck_dir(species_type), 'manifest.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        return {'release': str(saved['release']), 'columns': saved['columns'].tolist(), 'eol_ids': saved['eol_ids'], 'hashes': saved['hashes']}
+
+def save_manifest(path, release, eol_ids, hashes):
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, release=release, columns=np.array(COLUMNS), eol_ids=eol_ids, hashes=hashes)
+    os.replace(path + '.tmp', path)
+
+
+# Creates the directory of a new release, named after the time with a suffix for releases in the same second
+def new_release_dir(species_type):
+    name = datetime.now().strftime('%Y%m%d-%H%M%S')
+    release, number = name, 1
+    while True:
+        directory = os.path.join(deck_dir(species_type), release)
+        try:
+            os.makedirs(directory)
+            return release, directory
+        except FileExistsError:
+            number += 1
+            release = f'{name}-{number}'
+
+# Compares the notes with the previous release. Returns which notes are new and which changed,
+# the EOL IDs of removed notes, and how many notes changed in each field.
+def diff(eol_ids, hashes, manifest):
+    positions = pd.Index(manifest['eol_ids']).get_indexer(eol_ids)
+    kept = positions >= 0
+    changed = np.zeros(len(eol_ids), dtype=bool)
+    changed_fields = {}
+    for i, column in enumerate(COLUMNS):
+        # A field that was not in the last release counts as changed in every note
+        if column in manifest['columns']:
+            different = kept & (hashes[:, i] != manifest['hashes'][positions, manifest['columns'].index(column)])
+        else:
+            different = kept
+        changed |= different
+        changed_fields[column] = int(different.sum())
+    removed = manifest['eol_ids'][~np.isin(manifest['eol_ids'], eol_ids)]
+    return ~kept, changed, removed, changed_fields
+
+
+# Records a release of the deck in data/releases. With delta=True (and an earlier release) only the
+# added and changed notes are written, as an update csv and package, with a list of removed notes.
+def create_release(deck, delta=True):
+    species_type = deck.value['type']
+    df = read_deck_csv(species_type).drop_duplicates(subset=['EOL ID'])
+    eol_ids = df['EOL ID'].astype('int64').to_numpy()
+    hashes = note_hashes(df)
+    manifest = load_manifest(species_type)
+
+    release, directory = new_release_dir(species_type)
+    summary = {'release': release, 'previous': manifest and manifest['release'], 'notes': len(df)}
+
+    if delta and manifest is not None:
+        added, changed, removed, changed_fields = diff(eol_ids, hashes, manifest)
+        df_update = df[added | changed]
+        name = f'The {species_type} Deck (update)'
+        create_csv(df_update, species_type, os.path.join(directory, f'{name}.csv'))
+        write_apkg(df_update, species_type, os.path.join(directory, f'{name}.apkg'))
+        # Imports cannot delete notes, removed notes are listed with their GUIDs to find them in Anki
+        pd.DataFrame({'EOL ID': removed, 'guid': [note_guid(species_type, eol_id) for eol_id in removed]}).to_csv(os.path.join(directory, 'removed.csv'), index=False)
+        summary.update(added=int(added.sum()), changed=int(changed.sum()), removed=len(removed),
+                       unchanged=int((~added & ~changed).sum()), changed_fields={column: count for column, count in changed_fields.items() if count})
+    else:
+        summary.update(added=len(df), changed=0, removed=0, unchanged=0, changed_fields={})
+
+    with open(os.path.join(directory, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=1)
+    save_manifest(os.path.join(directory, 'manifest.npz'), release, eol_ids, hashes)
+    shutil.copyfile(os.path.join(directory, 'manifest.npz'), os.path.join(deck_dir(species_type), 'manifest.npz'))
+
+    print(f"Release {release}: {summary['added']} added, {summary['changed']} changed, {summary['removed']} removed, {summary['unchanged']} unchanged")
+    for column, count in summary['changed_fields'].items():
+        print(f"  {column}: {count}")
+    return summary
+
+
+# Usage: python src/release.py <deck> [full], e.g. python src/release.py ANIMALS
+if __name__ == '__main__':
+    from taxa import Deck
+    create_release(Deck[sys.argv[1]], delta=not (len(sys.argv) > 2 and sys.argv[2] == 'full'))
@@ -1,41 +1,126 @@
-import pandas as pd
 import os
+import sys
 import csv
+import heapq
+import tempfile
+from taxa import Deck
+from fields import FIELDS
 
-# Sorts the rows of exported deck (to keep order when first downloaded)
-# Assuming exported notes as .txt with all options selected
+# Sorts the rows of exported decks (to keep order when first downloaded): genera first, then species,
+# each in taxonomic order. Assumes notes exported as .txt with all options selected.
+# Rows are sorted in runs of bounded size that are merged from temporary files, so exports of any size fit in memory.
 
-DECK_NAME = 'The Animal Deck'
-TAXONOMIC_SORT_COLUMN = 9
-AS_INT = False
+SORT_FIELD = 'Taxonomic sort'
+RANKS = {'genus': 0, 'species': 1} # Other ranks last
+RUN_BYTES = 64 * 1024 * 1024 # Text held in memory per sorted run
+SEPARATORS = {'tab': '\t', 'comma': ',', 'semicolon': ';', 'space': ' ', 'pipe': '|', 'colon': ':'}
+META_COLUMNS = {'guid column', 'notetype column', 'deck column', 'tags column'}
 
-def extract_rank(tag_string):
-    if pd.isnull(tag_string):
+csv.field_size_limit(sys.maxsize)
+
+
+def export_path(deck, suffix=''):
+    return os.path.join('data', 'output', f"The {deck.value['type']} Deck{suffix}.txt")
+
+# Reads the '#key:value' directives at the top of the export, returns them with the raw lines
+def read_directives(f):
+    directives, lines = {}, []
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line.startswith('#'):
+            f.seek(position)
+            return directives, lines
+        key, _, value = line[1:].rstrip('\r\n').partition(':')
+        directives[key.strip().lower()] = value.strip()
+        lines.append(line)
+
+# Column names of the export: from the #columns directive if there is one, otherwise the guid, note type,
+# deck and tags columns from their directives and the fields of the note type in the other columns.
+# Anki does not always write #columns: without it, the other columns are only taken as the fields of the
+# note type when there are exactly as many of them, and None is returned otherwise.
+def column_names(directives, width, separator):
+    if 'columns' in directives:
+        return directives['columns'].split(separator)
+    names = [None] * width
+    for key in META_COLUMNS & directives.keys():
+        names[int(directives[key]) - 1] = key.removesuffix(' column')
+    if names.count(None) != len(FIELDS):
         return None
-    if "genus" in tag_string.split():
-        return "genus"
-    if "species" in tag_string.split():
-        return "species"
-    return None
+    fields = iter(FIELDS)
+    return [name or next(fields) for name in names]
+
+def make_sort_key(tags_column, sort_column):
+    # Sort values are compared as numbers when they are numbers (with or without leading zeros), missing values last
+    def sort_key(row):
+        tags = row[tags_column].split() if tags_column < len(row) else []
+        rank = RANKS['genus'] if 'genus' in tags else RANKS['species'] if 'species' in tags else len(RANKS)
+        value = row[sort_column] if sort_column < len(row) else ''
+        return (rank, 0, int(value), '') if value.isdigit() else (rank, 1 if value else 2, 0, value)
+    return sort_key
+
+
+def write_run(rows, sort_key, directory):
+    rows.sort(key=sort_key)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', dir=directory, suffix='.tsv', delete=False) as f:
+        csv.writer(f, delimiter='\t', lineterminator='\n').writerows(rows)
+    return f.name
+
+def read_run(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        yield from csv.reader(f, delimiter='\t')
 
-def sort_rows():
-    df_header = pd.read_csv(os.path.join('data', 'output', f'{DECK_NAME}.txt'), sep='\t', nrows=6, header=None, dtype=str)
-    df = pd.read_csv(os.path.join('data', 'output', f'{DECK_NAME}.txt'), sep='\t', skiprows=6, header=None, dtype={i: int if AS_INT and i == TAXONOMIC_SORT_COLUMN + 3 else str for i in range(75)})
+# Sorts the rows of one export into '<deck> sorted.txt', writing them as they come out of the merge.
+# sort_column is the number of the column to sort by (counting from 1), by default the Taxonomic sort field.
+def sort_rows(deck, sort_column=None):
+    path = export_path(deck)
+    with open(path, encoding='utf-8', newline='') as f, tempfile.TemporaryDirectory() as directory:
+        directives, header = read_directives(f)
+        separator = SEPARATORS.get(directives.get('separator', 'tab').lower(), directives.get('separator'))
+        reader = (row for row in csv.reader(f, delimiter=separator) if row)
+        first = next(reader, None)
+        if first is None:
+            print(f"{path} has no notes")
+            return
+        names = column_names(directives, len(first), separator)
+        if sort_column is None and names is None:
+            raise ValueError(f"{path} has no #columns line and {len(first)} columns, which do not match the {len(FIELDS)} fields of the Species note type. Pass the number of the {SORT_FIELD} column with --column.")
+        tags_column = names.index('tags') if names and 'tags' in names else int(directives['tags column']) - 1 if 'tags column' in directives else None
+        if tags_column is None or sort_column is None and SORT_FIELD not in names:
+            raise ValueError(f"Cannot find the {SORT_FIELD} and tags columns in {path}")
+        sort_key = make_sort_key(tags_column, sort_column - 1 if sort_column else names.index(SORT_FIELD))
 
-    # Extract tag column from header
-    tags_column = int(df_header.iloc[5, 0][13:]) - 1
+        # Sorted runs of at most RUN_BYTES, the last one is kept in memory
+        runs, rows, size = [], [first], sum(map(len, first))
+        for row in reader:
+            if size > RUN_BYTES:
+                runs.append(write_run(rows, sort_key, directory))
+                rows, size = [], 0
+            rows.append(row)
+            size += sum(map(len, row))
+        rows.sort(key=sort_key)
 
-    # Extract rank and sort
-    df["rank"] = df.iloc[:, tags_column].apply(extract_rank)
-    df["rank"] = pd.Categorical(df["rank"], categories=["genus", "species"], ordered=True)
-    df.sort_values(by=["rank", df.columns[TAXONOMIC_SORT_COLUMN + 3]], inplace=True)
-    df.drop(columns=["rank"], inplace=True)
+        # heapq.merge takes equal rows from earlier runs first, so the sort is stable
+        with open(export_path(deck, ' sorted'), 'w', encoding='utf-8', newline='') as out:
+            out.writelines(header)
+            writer = csv.writer(out, delimiter=separator, quoting=csv.QUOTE_ALL, lineterminator='\n')
+            notes = 0
+            for row in heapq.merge(*map(read_run, runs), rows, key=sort_key):
+                writer.writerow(row)
+                notes += 1
+    print(f"Sorted {notes} notes of {path} in {len(runs) + 1} runs")
 
-    # Combine with header and save
-    with open(os.path.join('data', 'output', f'{DECK_NAME} sorted.txt'), 'w', encoding='UTF8', newline='') as f:
-        df_header.to_csv(f, sep='\t', index=False, header=False)
-        df.to_csv(f, sep='\t', index=False, header=False, quoting=csv.QUOTE_STRINGS)
+def sort_decks(decks, sort_column=None):
+    for deck in decks:
+        if os.path.exists(export_path(deck)):
+            sort_rows(deck, sort_column)
 
 
+# Usage: python src/sort.py [deck ...] [--column N], e.g. python src/sort.py ANIMALS PLANTS (default: every deck with an export)
 if __name__ == '__main__':
-    sort_rows()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('decks', nargs='*', type=str.upper, choices=[deck.name for deck in Deck])
+    parser.add_argument('--column', type=int, help=f'number of the column to sort by, counting from 1 (default: the {SORT_FIELD} column)')
+    args = parser.parse_args()
+    sort_decks([Deck[name] for name in args.decks] or list(Deck), args.column)
@@ -0,0 +1,111 @@
+import os
+import sys
+import csv
+import shutil
+from types import SimpleNamespace
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from combine_data import csv_header
+from apkg import read_deck_csv
+from instrument import step
+
+SUBDECK_DIR = os.path.join('data', 'output', 'subdecks')
+COUNTRY_PREFIX = 'OBS::'
+CLADE_LEVELS = [2, 3] # Taxonomy tag levels to make decks of: Kingdom::Class and Kingdom::Class::Order
+MIN_NOTES = 10 # Smaller sub-decks are not written
+
+_lines = None # Csv lines of the notes, set in each worker
+
+
+# Maps every tag to the positions of the rows that have it, in row order
+def build_tag_index(tags):
+    exploded = tags.str.split().explode().dropna()
+    codes, uniques = pd.factorize(exploded)
+    positions = exploded.index.to_numpy()[np.argsort(codes, kind='stable')]
+    bounds = np.zeros(len(uniques) + 1, dtype='int64')
+    np.cumsum(np.bincount(codes, minlength=len(uniques)), out=bounds[1:])
+    return {tag: positions[bounds[i]:bounds[i + 1]] for i, tag in enumerate(uniques)}
+
+# Sub-decks per country, from the OBS:: tags
+def country_decks(index):
+    return {tag[len(COUNTRY_PREFIX):]: positions for tag, positions in index.items() if tag.startswith(COUNTRY_PREFIX)}
+
+# Sub-decks per class and order, merged from the taxonomy tags (Kingdom::Class::Order::Family) under them
+def clade_decks(index, kingdom):
+    clades = {}
+    for tag, positions in index.items():
+        if not tag.startswith(kingdom + '::'):
+            continue
+        names = tag.split('::')
+        for level in CLADE_LEVELS:
+            if len(names) >= level:
+                clades.setdefault('::'.join(names[1:level]), []).append(positions)
+    return {clade: np.sort(np.concatenate(positions)) for clade, positions in clades.items()}
+
+# Every note as one csv line, rendered once and shared by all sub-decks
+def render_lines(df):
+    lines = []
+    csv.writer(SimpleNamespace(write=lines.append), lineterminator='\n').writerows(df.itertuples(index=False, name=None))
+    return lines
+
+
+def init_worker(lines):
+    global _lines
+    _lines = lines
+
+def write_subdeck(path, deck_name, positions):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(csv_header(deck_name))
+        f.writelines(_lines[i] for i in positions)
+    return len(positions)
+
+
+# Writes a deck csv for every country and every class and order of the deck to data/output/subdecks,
+# each as a sub-deck in Anki (e.g. 'The Animal Deck::Denmark') ordered by observations.
+# The deck csv is read and indexed once, and the sub-decks are written in parallel processes
+# (workers=1 writes them in this process).
+def create_subdecks(deck, kinds=('countries', 'clades'), workers=None):
+    species_type = deck.value['type']
+    deck_name = f'The {species_type} Deck'
+    print("Creating sub-decks...")
+    with step('index tags') as s:
+        # Sorted once by observations, so the positions of every tag are already in the order of the sub-deck
+        df = read_deck_csv(species_type).sort_values('Observations sort', kind='stable', ignore_index=True)
+        s.rows_in = len(df)
+        index = build_tag_index(df['Tags'])
+        s.rows_out = s.info['tags'] = len(index)
+
+    subdecks = {}
+    if 'countries' in kinds:
+        subdecks['countries'] = country_decks(index)
+    if 'clades' in kinds:
+        subdecks['clades'] = clade_decks(index, deck.value['kingdom'])
+
+    directory = os.path.join(SUBDECK_DIR, deck_name)
+    shutil.rmtree(directory, ignore_errors=True)
+    tasks = []
+    for kind, decks in subdecks.items():
+        os.makedirs(os.path.join(directory, kind))
+        for name, positions in sorted(decks.items()):
+            if len(positions) >= MIN_NOTES:
+                title = name.replace('-', ' ')
+                tasks.append((os.path.join(directory, kind, f"{title.replace('::', ' - ').replace('/', '-')}.csv"), f'{deck_name}::{title}', positions.tolist()))
+
+    with step('write sub-decks', rows_in=len(tasks)) as s:
+        lines = render_lines(df)
+        paths, names, positions = zip(*tasks) if tasks else ((), (), ())
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(lines,)) if workers != 1 else nullcontext() as executor:
+            if executor is None:
+                init_worker(lines)
+            results = executor.map(write_subdeck, paths, names, positions, chunksize=16) if executor else map(write_subdeck, paths, names, positions)
+            s.info['notes'] = sum(results)
+        s.rows_out = len(tasks)
+    print(f"Wrote {len(tasks)} sub-decks with {s.info['notes']} notes to {directory}")
+
+
+# Usage: python src/subdecks.py <deck> [countries|clades], e.g. python src/subdecks.py ANIMALS countries
+if __name__ == '__main__':
+    from taxa import Deck
+    create_subdecks(Deck[sys.argv[1]], sys.argv[2:] or ('countries', 'clades'))
@@ -0,0 +1,163 @@
+import os
+import csv
+import json
+import random
+from taxa import Deck, BIRD_TAXA
+from translations import LANGUAGES
+
+# Synthetic inputs with the same columns and formats as the real downloads, for benchmarks.
+# Bump GENERATOR_VERSION when the output changes, so cached benchmark inputs are regenerated.
+GENERATOR_VERSION = 5
+
+SPM = 'http://rs.tdwg.org/ontology/voc/SPMInfoItems#'
+RANKS = ['species'] * 6 + ['genus', 'family', 'subspecies']
+WORDS = ['brown', 'spotted', 'long', 'tail', 'wing', 'small', 'large', 'dark', 'pale', 'stripe', 'body', 'head', 'legs', 'with', 'and', 'the', 'a', 'of']
+LANGUAGE_CODES = [code for _, codes in LANGUAGES for code in codes] + ['deu', 'zho', 'kor']
+COUNTRIES = ['US', 'CA', 'MX', 'BR', 'GB', 'DE', 'FR', 'DK', 'SE', 'NO', 'ES', 'IT', 'AU', 'NZ', 'ZA', 'IN', 'CN', 'JP', 'NA', 'ZZ']
+CLADES = [Deck.ANIMALS.value['taxa'][0], Deck.ANIMALS.value['taxa'][0] + '|Bilateria|Protostomia|Ecdysozoa|Arthropoda|Hexapoda|Insecta', Deck.ANIMALS.value['taxa'][0] + '|Bilateria|Deuterostomia|Chordata|Vertebrata|Tetrapoda|Amniota|Synapsida|Mammalia', BIRD_TAXA, Deck.PLANTS.value['taxa'][0], Deck.FUNGUS.value['taxa'][0], 'Life|Cellular Organisms|Bacteria']
+
+TAXON_COLUMNS = ['taxonID', 'source', 'furtherInformationURL', 'acceptedNameUsageID', 'parentNameUsageID', 'scientificName', 'higherClassification', 'taxonRank', 'taxonomicStatus', 'taxonRemarks', 'datasetID', 'canonicalName', 'eolID', 'Landmark']
+MEDIA_COLUMNS = ['identifier', 'taxonID', 'type', 'format', 'CVterm', 'title', 'description', 'furtherInformationURL', 'language', 'UsageTerms', 'Owner']
+# Share of taxa with a description from each resource, with the resource id and section term
+MEDIA_RESOURCES = {
+    'wikipedia': (0.3, 617, SPM + 'Description'),
+    'animal_diversity_web': (0.05, 560, SPM + 'Morphology'),
+    'fishbase': (0.05, 395, SPM + 'DiagnosticDescription'),
+    'arkive': (0.02, 775, SPM + 'Description'),
+    'amphibia_web': (0.01, 564, SPM + 'GeneralDescription'),
+}
+# Share of taxa with a key from each provider, including resources the pipeline does not use
+PROVIDER_COVERAGE = {1177: 0.95, 1178: 0.95, **{resource_id: min(coverage * 1.5, 1) for coverage, resource_id, _ in MEDIA_RESOURCES.values()}, 1: 0.5, 2: 0.5}
+
+def eol_id(i):
+    return 1000 + i
+
+def inaturalist_id(i):
+    return 1 + i
+
+def gbif_id(i):
+    return 2_000_000 + i
+
+def resource_pk(resource_id, i):
+    return {1177: inaturalist_id(i), 1178: gbif_id(i), 617: f'Q{i}', 775: f'ark{i}', 560: f'adw{i}', 395: f'fb{i}', 564: f'aw{i}'}.get(resource_id, f'r{resource_id}-{i}')
+
+def words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def write_taxa(directory, taxa, rng):
+    with open(os.path.join(directory, 'taxon.tab'), 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_NONE, escapechar='\\')
+        writer.writerow(TAXON_COLUMNS)
+        for i in range(taxa):
+            name = f'Genus{i // 7} species{i}'
+            classification = '' if rng.random() < 0.01 else f'{rng.choice(CLADES)}|Clade{i % 50}|Family{i % 997}'
+            writer.writerow([f'EOL-{i:012d}', 'trunk', '', '', f'EOL-{i // 7:012d}', name, classification, rng.choice(RANKS), 'accepted', '', 'trunk', name, eol_id(i), ''])
+
+def write_provider_ids(directory, taxa, rng):
+    with open(os.path.join(directory, 'full_provider_ids.csv'), 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['node_id', 'resource_pk', 'resource_id', 'page_id', 'preferred_canonical_for_page'])
+        for i in range(taxa):
+            for resource_id, coverage in PROVIDER_COVERAGE.items():
+                if rng.random() < coverage:
+                    # Some pages have an outdated key before the current one
+                    if rng.random() < 0.02:
+                        writer.writerow([i, resource_pk(resource_id, i + taxa), resource_id, eol_id(i), f'Genus{i // 7} species{i}'])
+                    writer.writerow([i, resource_pk(resource_id, i), resource_id, eol_id(i), f'Genus{i // 7} species{i}'])
+
+def write_vernacular_names(directory, taxa, rng):
+    with open(os.path.join(directory, 'vernacularnames.csv'), 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['page_id', 'canonical_form', 'vernacular_string', 'language_code', 'resource_name', 'is_preferred_by_resource', 'is_preferred_by_eol'])
+        for i in range(taxa):
+            for _ in range(rng.choice([0, 0, 1, 2, 3, 5, 8])):
+                name = f'{rng.choice(["common ", "", "Lesser ", "great "])}{words(rng, rng.randint(1, 3))}{rng.choice(["", "-fish", " bird"])}'
+                writer.writerow([eol_id(i), f'Genus{i // 7} species{i}', name, rng.choice(LANGUAGE_CODES), 'Resource', rng.choice(['preferred', '', '']), rng.choice(['preferred', 'preferred', ''])])
+
+def description(rng, resource):
+    if resource == 'wikipedia':
+        sections = ''.join(f'<p>{words(rng, rng.randint(20, 120))}<sup id="cite_ref-{j}" class="reference"><a href="#cite_note-{j}">[{j}]</a></sup></p>' for j in range(rng.randint(1, 6)))
+        header = rng.choice(['Description', 'Morphology', 'Habitat'])
+        return f'<p>{words(rng, 30)}</p><h2><span class="mw-headline" id="{header}">{header}</span></h2>{sections}<h2><span id="Distribution">Distribution</span></h2><p>{words(rng, 20)}</p>'
+    if resource == 'animal_diversity_web':
+        return ''.join(rng.choice([f'<p><strong>Trait:</strong> {words(rng, 4)}</p>', f'<p>{words(rng, 60)} (Smith, {rng.randint(1950, 2020)}).</p>', f'<p>{words(rng, 20)}\\n<a href="http://animaldiversity.ummz.umich.edu/site/accounts/x">old</a> {words(rng, 10)}</p>']) for _ in range(rng.randint(1, 5)))
+    if resource == 'amphibia_web':
+        return ''.join(f'<p>{words(rng, rng.randint(20, 150))} (Frost {rng.randint(1950, 2020)})</p>' for _ in range(rng.randint(1, 5)))
+    if resource == 'fishbase':
+        return f'{words(rng, rng.randint(10, 60))} (Ref. {rng.randint(1, 99999)}) {words(rng, 5)}'
+    return f'{words(rng, rng.randint(20, 80))} ({rng.randint(1, 20)}) {words(rng, 10)}.'
+
+def write_media(directory, taxa, rng):
+    for resource, (coverage, resource_id, term) in MEDIA_RESOURCES.items():
+        os.makedirs(os.path.join(directory, resource), exist_ok=True)
+        with open(os.path.join(directory, resource, 'media_resource.tab'), 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_NONE, escapechar='\\', quotechar='\x00')
+            writer.writerow(MEDIA_COLUMNS)
+            for i in range(taxa):
+                if rng.random() >= coverage:
+                    continue
+                pk = resource_pk(resource_id, i)
+                terms = [term, SPM + 'TaxonBiology'] if resource == 'wikipedia' else [term, SPM + 'Habitat']
+                for section in terms:
+                    title = section if resource == 'arkive' else ''
+                    writer.writerow([f'{resource}-{i}-{section[-5:]}', pk, 'http://purl.org/dc/dcmitype/Text', 'text/html', section, title, description(rng, resource), f'https://example.org/{resource}/{pk}&oldid={i}', 'en', 'http://creativecommons.org/licenses/by-sa/3.0/', ''])
+
+# Each row counts a range of occurrence ids, the delta export counts occurrences after those of the full export
+def write_gbif_rows(path, rows, first_id):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['taxonkey', 'countrycode', 'observation_count', 'min_gbifid', 'max_gbifid'])
+        for key, country, count in rows:
+            writer.writerow([key, country, count, first_id, first_id + count - 1])
+            first_id += count
+    return first_id
+
+def write_gbif_output(directory, taxa, rng):
+    # Twice as many taxon keys as taxa: GBIF covers much more than the decks
+    rows = [(key, country, int(rng.paretovariate(0.8))) for key in range(gbif_id(0), gbif_id(taxa * 2)) for country in rng.sample(COUNTRIES, rng.choice([1, 1, 2, 3, 5, 10]))]
+    next_id = write_gbif_rows(os.path.join(directory, 'GBIF_output.csv'), rows, 1)
+    # A refresh adds a few observations to a tenth of the taxa, in countries they already have and new ones
+    delta = [(key, country, int(rng.paretovariate(1.5))) for key in rng.sample(range(gbif_id(0), gbif_id(taxa * 2)), taxa // 5) for country in rng.sample(COUNTRIES, rng.choice([1, 2, 3]))]
+    write_gbif_rows(os.path.join(directory, 'GBIF_delta.csv'), delta, next_id)
+
+
+def photo(rng, photo_id):
+    license_code = rng.choice(['cc-by', 'cc-by-nc', 'cc-by-sa', 'cc0', None])
+    return {'photo': {'id': photo_id, 'license_code': license_code, 'attribution': f'(c) Observer {photo_id % 1000}, some rights reserved (CC BY)', **{f'{size}_url': f'https://inaturalist-open-data.s3.amazonaws.com/photos/{photo_id}/{size}.jpg' for size in ['small', 'medium', 'large']}}}
+
+# One result of the iNaturalist taxa endpoint (only the fields in INAT_QUERY_URL)
+def inaturalist_result(rng, taxon_id):
+    ancestors = [{'rank': rank, 'name': f'{rank.title()}{taxon_id % 97}', **({'preferred_common_name': f'{rank} {taxon_id % 13}'} if rng.random() < 0.7 else {})} for rank in ['kingdom', 'phylum', 'class', 'order', 'family', 'genus']]
+    ancestors[0]['name'] = 'Animalia'
+    ancestors[0]['preferred_common_name'] = 'Animals'
+    return {
+        'id': taxon_id,
+        'preferred_common_name': words(rng, 2) if rng.random() < 0.6 else None,
+        'conservation_statuses': [{'place': rng.choice([None, {'id': 1}]), 'status': rng.choice(['LC', 'NT', 'VU', 'EN'])} for _ in range(rng.choice([0, 0, 1, 2]))],
+        'extinct': rng.random() < 0.01,
+        'observations_count': int(rng.paretovariate(0.6)),
+        'rank': rng.choice(RANKS),
+        'ancestors': ancestors,
+        'taxon_photos': [photo(rng, taxon_id * 10 + j) for j in range(rng.randint(0, 10))],
+    }
+
+
+# Writes all raw input files for the given number of taxa to directory (usually data/input)
+def generate_inputs(directory, taxa, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    for write in [write_taxa, write_provider_ids, write_vernacular_names, write_media, write_gbif_output]:
+        write(directory, taxa, random.Random(f'{seed}-{write.__name__}'))
+    with open(os.path.join(directory, 'synthetic.json'), 'w', encoding='utf-8') as f:
+        json.dump({'taxa': taxa, 'seed': seed, 'version': GENERATOR_VERSION}, f)
+
+# Each taxon's result depends only on the seed and its id, so the mock API returns the same results
+def seeded_inaturalist_result(taxon_id, seed=0):
+    return inaturalist_result(random.Random(f'{seed}-inaturalist-{taxon_id}'), taxon_id)
+
+# Fills the iNaturalist cache with synthetic results, so get_images runs without network access
+def generate_inaturalist_cache(cache, ids, seed=0):
+    ids = list(ids)
+    for i in range(0, len(ids), 1000):
+        batch = ids[i:i + 1000]
+        cache.store(batch, [seeded_inaturalist_result(int(taxon_id), seed) for taxon_id in batch])
@@ -1,6 +1,17 @@
 from enum import Enum
 
+BIRD_TAXA = 'Life|Cellular Organisms|Eukaryota|Opisthokonta|Metazoa|Bilateria|Deuterostomia|Chordata|Vertebrata|Gnathostomata|Osteichthyes|Sarcopterygii|Tetrapoda|Amniota|Reptilia|Diapsida|Archosauromorpha|Archosauria|Dinosauria|Saurischia|Theropoda|Tetanurae|Coelurosauria|Maniraptoriformes|Maniraptora|Aves'
+
+# 'taxa' are the clades in the deck and 'exclude' the clades left out of it. A clade is either
+# a full higherClassification path or a single clade name, e.g. 'Insecta'.
 class Deck(Enum):
-    ANIMALS = {'type': 'Animal', 'kingdom': 'Animals', 'taxa': 'Life|Cellular Organisms|Eukaryota|Opisthokonta|Metazoa', 'taxon_rank': ['species']}
-    PLANTS = {'type': 'Plant', 'kingdom': 'Plants', 'taxa': 'Life|Cellular Organisms|Eukaryota|Archaeplastida|Chloroplastida', 'taxon_rank': ['genus', 'species']}
-    FUNGUS = {'type': 'Fungus', 'kingdom': 'Fungi', 'taxa': 'Life|Cellular Organisms|Eukaryota|Opisthokonta|Nucletmycea|Fungi', 'taxon_rank': ['genus', 'species']}
\ No newline at end of file
+    ANIMALS = {'type': 'Animal', 'kingdom': 'Animals', 'taxa': ['Life|Cellular Organisms|Eukaryota|Opisthokonta|Metazoa'], 'exclude': [BIRD_TAXA], 'taxon_rank': ['species']} # Birds have their own deck
+    PLANTS = {'type': 'Plant', 'kingdom': 'Plants', 'taxa': ['Life|Cellular Organisms|Eukaryota|Archaeplastida|Chloroplastida'], 'exclude': [], 'taxon_rank': ['genus', 'species']}
+    FUNGUS = {'type': 'Fungus', 'kingdom': 'Fungi', 'taxa': ['Life|Cellular Organisms|Eukaryota|Opisthokonta|Nucletmycea|Fungi'], 'exclude': [], 'taxon_rank': ['genus', 'species']}
+    BIRDS = {'type': 'Bird', 'kingdom': 'Animals', 'taxa': [BIRD_TAXA], 'exclude': [], 'taxon_rank': ['species']}
+    INSECTS = {'type': 'Insect', 'kingdom': 'Animals', 'taxa': ['Insecta'], 'exclude': [], 'taxon_rank': ['species']}
+    MAMMALS = {'type': 'Mammal', 'kingdom': 'Animals', 'taxa': ['Mammalia'], 'exclude': [], 'taxon_rank': ['species']}
+
+# Stages accept either one deck or a list of decks
+def deck_list(decks):
+    return [decks] if isinstance(decks, Deck) else list(decks)
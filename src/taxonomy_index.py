@@ -0,0 +1,149 @@
+import os
+import json
+import bisect
+import numpy as np
+import pandas as pd
+from ingest import INPUT_DIR, iter_input
+from instrument import step
+
+INDEX_PATH = os.path.join('data', 'cache', 'taxonomy.npz')
+INDEX_VERSION = 1 # Bump when the saved arrays change
+
+
+def _pack(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype='int64')
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype='uint8'), offsets
+
+# Read-only list of the strings packed in one byte array, decoded only when accessed
+class _Strings:
+    def __init__(self, blob, offsets):
+        self.data = blob.tobytes()
+        self.offsets = offsets.tolist()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    # Indexes of the strings that contain text
+    def containing(self, text):
+        text = text.encode('utf-8')
+        found = set()
+        start = self.data.find(text)
+        while start >= 0:
+            found.add(bisect.bisect_right(self.offsets, start) - 1)
+            start = self.data.find(text, start + 1)
+        return sorted(found)
+
+
+# Nested-interval index of the EOL taxonomy in taxon.tab, built once and saved to disk.
+# Taxa are sorted by their higherClassification, so all taxa under a clade are one
+# contiguous range of rows. keys holds each distinct classification (with a trailing '|')
+# and starts the first row of each, so a clade's range is found with two binary searches.
+class TaxonomyIndex:
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.keys = _Strings(arrays['key_blob'], arrays['key_offsets'])
+        self.names = _Strings(arrays['name_blob'], arrays['name_offsets'])
+        self.starts = arrays['starts']
+        ranks = _Strings(arrays['rank_blob'], arrays['rank_offsets'])
+        self.ranks = [ranks[i] for i in range(len(ranks))]
+
+    @staticmethod
+    def _signature():
+        stat = os.stat(os.path.join(INPUT_DIR, 'taxon.tab'))
+        return json.dumps({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'version': INDEX_VERSION})
+
+    # Loads the saved index, or builds it when taxon.tab changed since it was saved
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        signature = cls._signature()
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                if str(saved['signature']) == signature:
+                    return cls({name: saved[name] for name in saved.files})
+
+        arrays = cls.build()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, signature=signature, **arrays)
+        os.replace(path + '.tmp', path)
+        return cls(arrays)
+
+    @staticmethod
+    def build():
+        with step('build taxonomy index') as s:
+            df = pd.concat(iter_input('taxon.tab', ['higherClassification', 'taxonRank', 'canonicalName', 'eolID']), ignore_index=True)
+            s.rows_in = len(df)
+            df = df.dropna(subset=['higherClassification'])
+            # Keep the position in the file, results are returned in file (taxonomic) order
+            df['row'] = df.index
+            df['key'] = df['higherClassification'].astype(object) + '|'
+            df = df.sort_values('key', kind='stable')
+
+            keys, counts = np.unique(df['key'].to_numpy(dtype=object), return_counts=True)
+            starts = np.zeros(len(keys) + 1, dtype='int64')
+            np.cumsum(counts, out=starts[1:])
+            ranks = df['taxonRank'].astype('category')
+            names = df['canonicalName'].astype(object)
+            arrays = {
+                'starts': starts,
+                'rows': df['row'].to_numpy(dtype='int64'),
+                'eol_ids': df['eolID'].to_numpy(dtype='int64', na_value=-1),
+                'rank_codes': ranks.cat.codes.to_numpy(dtype='int16'),
+                'name_missing': names.isna().to_numpy(),
+            }
+            arrays['key_blob'], arrays['key_offsets'] = _pack(keys)
+            arrays['rank_blob'], arrays['rank_offsets'] = _pack(ranks.cat.categories)
+            arrays['name_blob'], arrays['name_offsets'] = _pack(names.fillna(''))
+            s.rows_out = len(df)
+            s.info['classifications'] = len(keys)
+        return arrays
+
+    # Row range of the taxa under a clade path like 'Life|Cellular Organisms|Eukaryota'
+    def subtree(self, path):
+        # Every classification under the path starts with 'path|', and '}' is the character after '|'
+        first = bisect.bisect_left(self.keys, path + '|')
+        last = bisect.bisect_left(self.keys, path + '}')
+        return self.starts[first], self.starts[last]
+
+    # A clade is a full path, or a single name that is looked up in all classifications
+    def clade_paths(self, clade):
+        if '|' in clade:
+            return [clade]
+        marker = f'|{clade}|'
+        paths = set()
+        # Also finds the clade as the first name of a key, the match is checked on the key itself
+        for i in self.keys.containing(clade + '|'):
+            key = '|' + self.keys[i]
+            found = key.find(marker)
+            if found >= 0:
+                paths.add(key[1:found + len(marker) - 1])
+        return sorted(paths)
+
+    def _positions(self, clades):
+        ranges = [self.subtree(path) for clade in clades for path in self.clade_paths(clade)]
+        if not ranges:
+            return np.zeros(0, dtype='int64')
+        return np.unique(np.concatenate([np.arange(first, last) for first, last in ranges]))
+
+    # All taxa under the included clades, except those under the excluded clades, at the given ranks
+    # Returns canonicalName and eolID in the order of taxon.tab
+    def select(self, include, exclude=(), ranks=None):
+        positions = self._positions(include)
+        if exclude:
+            positions = positions[~np.isin(positions, self._positions(exclude))]
+        if ranks is not None:
+            codes = [self.ranks.index(rank) for rank in ranks if rank in self.ranks]
+            positions = positions[np.isin(self.arrays['rank_codes'][positions], codes)]
+        positions = positions[np.argsort(self.arrays['rows'][positions], kind='stable')]
+
+        names = pd.Series([self.names[i] for i in positions.tolist()], dtype=object)
+        eol_ids = pd.array(self.arrays['eol_ids'][positions], dtype='Int64')
+        return pd.DataFrame({
+            'canonicalName': names.where(~self.arrays['name_missing'][positions]),
+            'eolID': pd.Series(eol_ids).where(self.arrays['eol_ids'][positions] != -1),
+        })
@@ -2,91 +2,77 @@ import pandas as pd
 import os
 from unidecode import unidecode
 from string import capwords
+from taxa import deck_list
+from ingest import iter_input
+from instrument import step
+from fields import LANGUAGES
 
-LANGUAGES = [
-    ('English', ['eng']),
-    ('Arabic', ['ara']),
-    ('Azerbaijani', ['aze']),
-    ('Bulgarian', ['bul']),
-    ('Catalan', ['cat']),
-    ('Croatian', ['hrv']),
-    ('Czech', ['cze']),
-    ('Danish', ['dan']),
-    ('Dutch', ['dut']),
-    ('Estonian', ['est']),
-    ('Finnish', ['fin']),
-    ('French', ['fre']),
-    ('German', ['ger']),
-    ('Hebrew', ['heb']),
-    ('Hungarian', ['hun']),
-    ('Indonesian', ['ind']),
-    ('Italian', ['ita']),
-    ('Japanese', ['jpn']),
-    ('Lithuanian', ['lit']),
-    ('Malay', ['may']),
-    ('Norwegian', ['nor', 'nob']),
-    ('Persian', ['per']),
-    ('Polish', ['pol']),
-    ('Portuguese', ['por']),
-    ('Russian', ['rus']),
-    ('Serbian', ['srp']),
-    ('Slovak', ['slo']),
-    ('Spanish', ['spa', 'sp']),
-    ('Swedish', ['swe']),
-    ('Thai', ['tha']),
-    ('Turkish', ['tur']),
-    ('Ukrainian', ['ukr']),
-    ('Vietnamese', ['vie']),
-]
+LANGUAGE_NAMES = {code: language for language, codes in LANGUAGES for code in codes}
 
-# Get only translations marked as "preferred"
+# Get only translations marked as "preferred" (for each language separately)
 def get_preferred_only(df_translations):
     df_translations = df_translations.dropna(subset=['is_preferred_by_eol'])
-    df_translations = df_translations.drop_duplicates(subset=['page_id', 'is_preferred_by_eol'])
-
-    preferred_groups = df_translations[df_translations['is_preferred_by_resource'] == 'preferred']['page_id']
-    preferred_groups = preferred_groups.drop_duplicates()
-
-    # Merge the original translations with the preferred groups, marking rows that belong to these groups
-    df_translations = df_translations.merge(preferred_groups, on='page_id', how='left', indicator='preferred_exists')
+    df_translations = df_translations.drop_duplicates(subset=['language', 'page_id', 'is_preferred_by_eol'])
 
     # Keep only preferred rows if they are preferred by resource too, otherwise, keep all
-    df_translations = df_translations[(df_translations['preferred_exists'] == 'both') & (df_translations['is_preferred_by_resource'] == 'preferred') | (df_translations['preferred_exists'] == 'left_only')]
-    return df_translations
+    preferred = df_translations['is_preferred_by_resource'] == 'preferred'
+    preferred_exists = preferred.groupby([df_translations['language'], df_translations['page_id']]).transform('any')
+    return df_translations[preferred | ~preferred_exists]
+
 
+# Key used to find translations written in almost the same way
+def normalize_name(name):
+    return unidecode(name.replace(' ', '').replace('-', '').replace("’", "'").lower().replace('common ', ''))
 
-# Merges multiple translations into a single cell
+# Merges multiple translations into a single cell per species and language
 def merge_translations(df_translations):
-    # Capitalize the first letter of each word
-    df_translations['vernacular_string'] = df_translations['vernacular_string'].fillna('').apply(capwords)
-    
+    # Capitalize the first letter of each word, computed once per unique name
+    codes, names = pd.factorize(df_translations['vernacular_string'].fillna(''))
+    capitalized = names.map(capwords)
+    df_translations = df_translations.assign(
+        vernacular_string=capitalized.take(codes),
+        vernacular_string_lower=capitalized.map(normalize_name).take(codes),
+    )
+
     # Remove duplicates written in almost same way
-    df_translations['vernacular_string_lower'] = df_translations['vernacular_string'].str.replace(' ', '').str.replace('-', '').str.replace("’", "'").str.lower().str.replace('common ', '').apply(unidecode)
-    df_translations = df_translations.drop_duplicates(subset=['page_id', 'language_code', 'vernacular_string_lower'])
+    df_translations = df_translations.drop_duplicates(subset=['page_id', 'language', 'language_code', 'vernacular_string_lower'])
 
     # Combine the rest of multiple translations into a single cell
-    df_translations = df_translations.groupby(['page_id', 'language_code'], as_index=False).agg({
-        'vernacular_string': ' / '.join
-    })
-    return df_translations
+    return df_translations.groupby(['page_id', 'language'])['vernacular_string'].agg(' / '.join)
 
 
-# Gets the translations for the species
-def get_translations(deck):
+# Gets the translations for the species of one or more decks, reading the vernacular names once
+def get_translations(decks):
     print("Getting translations...")
-    df = pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} species.csv'), usecols=['eolID'])
-    df_translations = pd.read_csv(os.path.join('data', 'input', 'vernacularnames.csv'), dtype={'page_id': int, 'canonical_form': str, 'vernacular_string': str, 'language_code': str, 'resource_name': str, 'is_preferred_by_resource': str, 'is_preferred_by_eol': str})
+    decks = deck_list(decks)
+    species = {deck: pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} species.csv'), usecols=['eolID']) for deck in decks}
+
+    # Keep only the wanted languages and species of the decks
+    page_ids = set().union(*(df['eolID'] for df in species.values()))
+    with step('read vernacularnames.csv') as s:
+        df_translations = pd.concat(
+            chunk[chunk['language_code'].isin(LANGUAGE_NAMES.keys()) & chunk['page_id'].isin(page_ids)]
+            for chunk in iter_input('vernacularnames.csv', ['page_id', 'vernacular_string', 'language_code', 'is_preferred_by_resource', 'is_preferred_by_eol'])
+        )
+        s.rows_out = len(df_translations)
+    df_translations = df_translations.astype({'language_code': object, 'is_preferred_by_resource': object, 'is_preferred_by_eol': object})
+    df_translations['language'] = df_translations['language_code'].map(LANGUAGE_NAMES)
+
+    # All languages are handled together and turned into one column per language
+    with step('preferred names', rows_in=len(df_translations)) as s:
+        df_translations = get_preferred_only(df_translations)
+        s.rows_out = len(df_translations)
+    with step('merge names', rows_in=len(df_translations)) as s:
+        df_translations = merge_translations(df_translations)
+        s.rows_out = len(df_translations)
+        # Species with a name in each language
+        s.info['species_per_language'] = df_translations.groupby(level='language').size().to_dict()
+    df_translations = df_translations.unstack('language').reindex(columns=[language for language, _ in LANGUAGES])
 
-    # Fill out translations for additional languages
-    for language, codes in LANGUAGES:
-        df_translations_lang = df_translations[df_translations['language_code'].isin(codes)]
-        df_translations_lang = get_preferred_only(df_translations_lang)
-        df_translations_lang = merge_translations(df_translations_lang)
-        
-        # Merge and rename the vernacular_string column to the language name
-        df = df.merge(df_translations_lang[['page_id', 'vernacular_string']], left_on='eolID', right_on='page_id', how='left')
-        df.rename(columns={f'vernacular_string': language}, inplace=True)
-        df.drop(columns=['page_id'], inplace=True)
+    for deck, df in species.items():
+        with step(f"{deck.value['type']} merge", rows_in=len(df)) as s:
+            df = df.merge(df_translations, left_on='eolID', right_index=True, how='left')
+            s.rows_out = len(df)
 
-    # Save the updated DataFrame to a file
-    df.to_csv(os.path.join('data', 'processed', f'{deck.value['type']} species with translations.csv'), index=False)
\ No newline at end of file
+        # Save the updated DataFrame to a file
+        df.to_csv(os.path.join('data', 'processed', f'{deck.value['type']} species with translations.csv'), index=False)
\ No newline at end of file
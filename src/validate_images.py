@@ -0,0 +1,140 @@
+import os
+import time
+import sqlite3
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from combine_data import UNWANTED_IMG_URLS, UNWANTED_SPECIES, wanted_taxa
+from inat_client import HEADERS
+from instrument import step
+
+CACHE_PATH = os.path.join('data', 'cache', 'image_checks.sqlite')
+DEFAULT_TTL = 30 * 24 * 60 * 60 # Recheck images older than 30 days
+WORKERS = 32 # Concurrent HEAD requests
+BROKEN_STATUSES = {403, 404, 410} # The photo bucket answers 403 for deleted photos
+PHOTO_ID = r'/photos/(\d+)/'
+SRCSET_URL = r'([^\s",]+) \d+w' # The cards mostly load the small and medium variants of the srcset
+
+
+# Persistent cache of the status code of each image URL
+class ImageCheckCache:
+    def __init__(self, path=CACHE_PATH, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, checked_at REAL NOT NULL, status INTEGER NOT NULL)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.connection.close()
+
+    # Status codes of the URLs checked within the TTL
+    def fresh(self, urls):
+        cutoff = time.time() - self.ttl
+        statuses = {}
+        for i in range(0, len(urls), 900):
+            chunk = urls[i:i + 900]
+            rows = self.connection.execute(f'SELECT url, status FROM images WHERE checked_at >= ? AND url IN ({",".join("?" * len(chunk))})', [cutoff, *chunk])
+            statuses.update(rows)
+        return statuses
+
+    def store(self, statuses):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO images (url, checked_at, status) VALUES (?, ?, ?)', [(url, now, status) for url, status in statuses.items()])
+
+
+# One row per image of every taxon, with its position in the taxon's Images, its photo id and the URLs of
+# all of its variants (only the src for images without a srcset)
+def list_images(df):
+    images = df.set_index(['eolID', 'inaturalistID', 'rank'])['images'].dropna().str.split(';;').explode()
+    images = images.reset_index()
+    images['position'] = images.groupby('eolID').cumcount()
+    images['url'] = images['images'].str.extract(r'<img src="([^"]*)"', expand=False)
+    images['photo_id'] = images['url'].str.extract(PHOTO_ID, expand=False)
+    images['variants'] = [variants or [url] for variants, url in zip(images['images'].str.findall(SRCSET_URL), images['url'])]
+    return images.drop(columns=['images'])
+
+# A photo on several taxa of the same rank is kept where it comes first in the taxon's images (the first
+# taxon in the deck on ties). Genera are expected to share photos with their species, and EOL pages of the
+# same iNaturalist taxon have the same photos, so they are not duplicates of each other.
+def find_duplicates(images):
+    photos = images.dropna(subset=['photo_id']).sort_values('position', kind='stable')
+    groups = photos.groupby(['photo_id', 'rank'], observed=True)
+    first, first_taxon = groups['eolID'].transform('first'), groups['inaturalistID'].transform('first')
+    duplicates = photos[photos['inaturalistID'] != first_taxon]
+    return duplicates.assign(reason='duplicate of ' + first[duplicates.index].astype(str))
+
+# HEAD requests over pooled connections, returns the status of every URL (0 if the request failed)
+def check_urls(urls, workers, photo_url=None):
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    def check(url):
+        # The path is kept when the photos are served from a local stand-in
+        request_url = photo_url + urlsplit(url).path if photo_url else url
+        try:
+            return session.head(request_url, timeout=30, allow_redirects=True).status_code
+        except requests.RequestException:
+            return 0
+
+    with session, ThreadPoolExecutor(workers) as executor:
+        yield from zip(urls, executor.map(check, urls))
+
+
+# Checks every variant of every image of the deck and lists the images to leave out of the cards: images with
+# a variant that no longer resolves, copyright placeholders and photos already on another taxon. Results are cached for ttl seconds,
+# failed requests and server errors are not cached and the image is kept.
+# photo_url replaces the scheme and host of the image URLs, to check them against mock_inaturalist.py
+def validate_images(deck, ttl=DEFAULT_TTL, workers=WORKERS, photo_url=None):
+    print("Validating images...")
+    df = pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} species with images.csv'), usecols=['eolID', 'images', 'rank', 'taxonomy_tag'], dtype={'images': str, 'rank': 'category', 'taxonomy_tag': str})
+    species = pd.read_csv(os.path.join('data', 'processed', f'{deck.value['type']} species.csv'), usecols=['eolID', 'inaturalistID'], dtype={'inaturalistID': 'int64'})
+    with step('list images', rows_in=len(df)) as s:
+        # Only the taxa that combine_data() keeps, so a photo is not kept on a taxon that is left out of the deck
+        species = species[~species['eolID'].isin(UNWANTED_SPECIES)].drop_duplicates(subset=['eolID'])
+        df = df[wanted_taxa(df, deck)].merge(species, on='eolID')
+        images = list_images(df)
+        s.rows_out = len(images)
+
+    placeholders = images[images['url'].isin(UNWANTED_IMG_URLS) | images['url'].str.contains('copyright-infringement', regex=False, na=False)]
+    duplicates = find_duplicates(images)
+
+    variants = images.loc[~images.index.isin(placeholders.index), 'variants'].explode().dropna()
+    urls = variants.unique().tolist()
+    with ImageCheckCache(ttl=ttl) as cache, step('check urls', rows_in=len(urls)) as s:
+        statuses = cache.fresh(urls)
+        missing = [url for url in urls if url not in statuses]
+        print(f"{len(statuses)} images checked recently, checking {len(missing)}")
+        checked = {}
+        for url, status in check_urls(missing, workers, photo_url):
+            statuses[url] = checked[url] = status
+            # Definite answers only, in batches so an interrupted run resumes
+            if len(checked) >= 1000:
+                cache.store({url: status for url, status in checked.items() if 200 <= status < 500 and status != 429})
+                checked = {}
+        cache.store({url: status for url, status in checked.items() if 200 <= status < 500 and status != 429})
+        s.info.update(cached=len(urls) - len(missing), failed=sum(1 for url in missing if statuses[url] == 0 or statuses[url] >= 500))
+        s.rows_out = len(urls)
+
+    # An image is broken when any of its variants is, with the status of the first broken one
+    status = variants.map(statuses)
+    status = status[status.isin(BROKEN_STATUSES)].groupby(level=0).first()
+    broken = images.loc[status.index]
+    bad = pd.concat([
+        broken.assign(reason='status ' + status.astype(int).astype(str)),
+        placeholders.assign(reason='placeholder'),
+        duplicates,
+    ])
+    # An image that is broken and a duplicate is listed once
+    bad = bad.drop_duplicates(subset=['eolID', 'url']).sort_values(['eolID', 'position'])
+    print(f"{len(broken)} broken images, {len(placeholders)} placeholders, {len(duplicates)} duplicates")
+    bad[['eolID', 'url', 'reason']].to_csv(os.path.join('data', 'processed', f'{deck.value['type']} bad images.csv'), index=False)